@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import time
+from collections import defaultdict
 
 from amplify.agent.collectors.abstract import AbstractCollector
+from amplify.agent.collectors.nginx.parsepool import get_parse_pool, shard_spec
 from amplify.agent.common.context import context
-from amplify.agent.pipelines.abstract import Pipeline
+from amplify.agent.data.sketch import HeavyHitters
+from amplify.agent.pipelines.abstract import Pipeline, chunked
+from amplify.agent.pipelines.file import save_offsets
+from amplify.agent.objects.nginx.filters import FilterSet
 from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
-import copy
 
 
 __author__ = "Mike Belov"
@@ -15,6 +19,66 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+def http_status_metrics(status):
+    """
+    :param status: str $status
+    :return: () of counter names to increment
+    """
+    metrics = []
+
+    # add separate metrics for specific 4xx and 5xx codes
+    if status.startswith('4'):
+        if status in ('403', '404'):
+            metrics.append('nginx.http.status.%s' % status)
+    elif status.startswith('5'):
+        if status in ('500', '502', '503', '504'):
+            metrics.append('nginx.http.status.%s' % status)
+
+    metrics.append('nginx.http.status.%sxx' % status[0])
+
+    if status == '499':
+        metrics.append('nginx.http.status.discarded')
+
+    return tuple(intern(metric) for metric in metrics)
+
+
+def http_version_metric(protocol):
+    """
+    :param protocol: str $server_protocol
+    :return: str counter name or None
+    """
+    if not protocol.startswith('HTTP'):
+        return None
+
+    version = protocol.split('/')[-1]
+
+    # Ordered roughly by expected popularity to reduce number of calls to `startswith`
+    if version.startswith('1.1'):
+        suffix = '1_1'
+    elif version.startswith('2.0'):
+        suffix = '2'
+    elif version.startswith('1.0'):
+        suffix = '1_0'
+    elif version.startswith('0.9'):
+        suffix = '0_9'
+    else:
+        suffix = version.replace('.', '_')
+
+    return intern('nginx.http.v%s' % suffix)
+
+
+def upstream_status_metric(status):
+    """
+    :param status: str one of $upstream_status values
+    :return: (str counter name, bool response received) or None
+    """
+    if not status.isdigit():
+        return None
+
+    suffix = '%sxx' % status[0]
+    return intern('nginx.upstream.status.%s' % suffix), suffix in ('2xx', '3xx')
+
+
 class NginxAccessLogsCollector(AbstractCollector):
     short_name = 'nginx_alog'
 
@@ -79,11 +143,93 @@ class NginxAccessLogsCollector(AbstractCollector):
         'updating',
     )
 
+    # raw values -> counter names
+    method_metrics = dict(
+        (case(method), intern('nginx.http.method.%s' % method))
+        for method in valid_http_methods for case in (str.lower, str.upper)
+    )
+    status_metrics = dict((str(status), http_status_metrics(str(status))) for status in xrange(100, 600))
+    version_metrics = dict(
+        (protocol, http_version_metric(protocol)) for protocol in ('HTTP/1.1', 'HTTP/2.0', 'HTTP/1.0', 'HTTP/0.9', 'HTTP/2')
+    )
+    upstream_status_metrics = dict((str(status), upstream_status_metric(str(status))) for status in xrange(100, 600))
+    cache_metrics = dict(
+        (case(status), intern('nginx.cache.%s' % status))
+        for status in valid_cache_statuses for case in (str.lower, str.upper)
+    )
+
+    # timers that can be used by filters (as timer.median, timer.max, etc.)
+    timer_metrics = (
+        'nginx.http.request.time',
+        'nginx.upstream.connect.time',
+        'nginx.upstream.response.time',
+        'nginx.upstream.header.time',
+    )
+
+    upstream_timers = (
+        ('nginx.upstream.connect.time', 'upstream_connect_time'),
+        ('nginx.upstream.header.time', 'upstream_header_time'),
+        ('nginx.upstream.response.time', 'upstream_response_time'),
+    )
+
+    # peer name used for all peers above the limit
+    overflow_peer = 'overflow'
+
+    # pause between cycles while there is a backlog (seconds)
+    backlog_interval = 0.1
+
+    # parsed keys that every collector method reads
+    method_keys = {
+        'http_method': ('request_method',),
+        'http_status': ('status',),
+        'http_version': ('server_protocol',),
+        'request_length': ('request_length',),
+        'body_bytes_sent': ('body_bytes_sent',),
+        'bytes_sent': ('bytes_sent',),
+        'gzip_ration': ('gzip_ratio',),
+        'request_time': ('request_time',),
+        'upstreams': (),  # all upstream_* keys of the format, see needed_keys()
+        'top': ('status',),  # and top_keys, see needed_keys()
+        'upstream_peers': (
+            'upstream_addr', 'upstream_status', 'upstream_connect_time', 'upstream_header_time', 'upstream_response_time'
+        ),
+    }
+
+    # keys tracked by the top-k stage ($request_uri is a part of $request)
+    top_dimensions = (
+        'request_uri',
+        'remote_addr',
+        'http_user_agent',
+        'upstream_addr'
+    )
+
     def __init__(self, log_format=None, tail=None, **kwargs):
         super(NginxAccessLogsCollector, self).__init__(**kwargs)
         self.parser = NginxAccessLogParser(log_format)
         self.num_of_lines_in_log_format = self.parser.raw_format.count('\n')+1
         self.tail = tail
+        self.local_counters = defaultdict(int)  # pushed to statsd once per collect
+        self.multiline_record = []  # lines of a multiline record read so far
+
+        # limits of a single collect, the rest of the tail is left for the next cycles
+        nginx_config = context.app_config.get('nginx', {})
+        self.budget_time = float(nginx_config.get('log_budget_time', 1.0))
+        self.budget_lines = int(nginx_config.get('log_budget_lines', 0))
+        self.backlog = None  # unfinished chunks iterator
+        self.caught_up = time.time()  # when the tail was read to the end last time
+
+        # top-k keys per status class, pushed to statsd once per collect like local counters
+        self.top_k = int(nginx_config.get('log_top_k', 0))
+        self.top_width = int(nginx_config.get('log_top_width', 512))
+        self.top_depth = int(nginx_config.get('log_top_depth', 4))
+        self.local_top = {}
+        self.top_metrics = {}  # (key, status class) -> metric name
+
+        # per peer upstream metrics, at most "peer_limit" peers
+        self.peer_limit = int(nginx_config.get('log_upstream_peers', 0))
+        self.peer_metrics = {}  # peer -> (status metric names, timer metric names)
+        self.overflow_peer_metrics = self.create_peer_metrics(self.overflow_peer)
+
         # syslog tails names are "<type>:<name>"
         self.name = tail.name.split(':')[-1] if isinstance(tail, Pipeline) \
             else None
@@ -96,6 +242,8 @@ class NginxAccessLogsCollector(AbstractCollector):
             if not log_filter.matchfile(self.name):
                 continue
             self.filters.append(log_filter)
+        self.filter_set = FilterSet(self.filters)
+        self.parent_filters = self.create_parent_filters(self.filters)
 
         self.register(
             self.http_method,
@@ -106,9 +254,60 @@ class NginxAccessLogsCollector(AbstractCollector):
             self.bytes_sent,
             self.gzip_ration,
             self.request_time,
-            self.upstreams,
         )
 
+        # skip the whole upstreams pass if there's nothing to read from the format
+        self.upstream_keys = [key for key in self.parser.keys if key.startswith('upstream')]
+        if self.upstream_keys:
+            self.register(self.upstreams)
+            if self.peer_limit > 0 and 'upstream_addr' in self.upstream_keys:
+                self.register(self.upstream_peers)
+
+        self.top_keys = []
+        if self.top_k > 0:
+            self.top_keys = [
+                key for key in self.top_dimensions
+                if key in self.parser.keys or (key == 'request_uri' and 'request' in self.parser.keys)
+            ]
+            if self.top_keys:
+                self.register(self.top)
+
+        # don't split and cast values nobody reads
+        self.parser.compile(needed_keys=self.needed_keys())
+
+        # collectors with the same key can share parsed lines
+        needed_keys = self.parser.needed_keys
+        self.parse_key = (self.parser.raw_format, frozenset(needed_keys) if needed_keys is not None else None)
+
+        # parse in worker processes if they are configured
+        self.pool = get_parse_pool()
+        self.shard = shard_spec(self) if self.pool is not None else None
+
+    def needed_keys(self):
+        """
+        Collects keys of a parsed line read by registered methods and filters
+
+        :return: set of keys or None if unknown methods are registered
+        """
+        # malformed requests are detected by splitting $request
+        keys = set(['request'])
+
+        for method in self.methods:
+            if method.__name__ not in self.method_keys:
+                return None
+            keys.update(self.method_keys[method.__name__])
+
+        if self.upstreams in self.methods:
+            keys.update(self.upstream_keys)
+
+        if self.top in self.methods:
+            keys.update(self.top_keys)
+
+        for log_filter in self.filters:
+            keys.update(log_filter.data)
+
+        return keys
+
     def init_counters(self, counters=None):
         for counter, key in self.counters.iteritems():
             # If keys are in the parser format (access log) or not defined (error log)
@@ -123,30 +322,137 @@ class NginxAccessLogsCollector(AbstractCollector):
     def collect(self):
         self.init_counters()  # set all counters to 0
 
+        # continue with the chunks left from the previous cycle
+        if self.backlog is not None:
+            chunks = self.backlog
+        elif isinstance(self.tail, Pipeline):
+            chunks = self.tail.chunks()
+        else:
+            chunks = chunked(self.tail, Pipeline.chunk_lines)
+
+        try:
+            count, exhausted = self.collect_chunks(chunks)
+        finally:
+            self.push_counters()
+
+        self.backlog = chunks if exhausted else None
+        self.report_backlog()
+        self.report_drops()
+
+        tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
+        context.log.debug('%s processed %s lines from %s%s' % (
+            self.object.definition_hash, count, tail_name, ' (budget exhausted)' if exhausted else ''
+        ))
+
+        save_offsets()
+
+    def collect_chunks(self, chunks):
+        """
+        Processes chunks of lines until they end or the budget of the cycle is exhausted
+
+        :param chunks: iterator of line lists
+        :return: (int number of lines, bool budget exhausted)
+        """
         count = 0
-        multiline_record = []
-        for line in self.tail:
-            count += 1
+        deadline = time.time() + self.budget_time if self.budget_time > 0 else None
 
-            # release GIL every 1000 of lines
-            if count % (1000 * self.num_of_lines_in_log_format) == 0:
-                time.sleep(0.001)
+        for lines in chunks:
+            count += len(lines)
 
             # handle multiline log formats
             if self.num_of_lines_in_log_format > 1:
-                multiline_record.append(line)
-                if len(multiline_record) < self.num_of_lines_in_log_format:
-                    continue
-                else:
-                    line = '\n'.join(multiline_record)
-                    multiline_record = []
+                records = []
+                for line in lines:
+                    self.multiline_record.append(line)
+                    if len(self.multiline_record) == self.num_of_lines_in_log_format:
+                        records.append('\n'.join(self.multiline_record))
+                        self.multiline_record = []
+            else:
+                records = lines
+
+            partial = self.pool.process(self, records) if self.pool is not None else None
+            if partial is not None:
+                self.merge(partial)
+            elif records is lines and hasattr(lines, 'parsed'):
+                # lines are shared with other collectors of the same file, parse them once per parser
+                parsed_records = lines.parsed.get(self.parse_key)
+                if parsed_records is None:
+                    parsed_records = lines.parsed[self.parse_key] = self.parse(records)
+                self.process(records, parsed_records)
+            else:
+                self.process(records)
+
+            # release GIL after every chunk of lines
+            time.sleep(0.001)
+
+            if deadline is not None and time.time() >= deadline:
+                return count, True
+            if self.budget_lines and count >= self.budget_lines:
+                return count, True
+
+        return count, False
+
+    def report_backlog(self):
+        """
+        Reports unread bytes of the tail and seconds since it was read to the end
+        """
+        now = time.time()
+        if self.backlog is None:
+            self.caught_up = now
+
+        if self.name is None:
+            return
+
+        backlog_bytes = self.tail.backlog()
+        if backlog_bytes is not None:
+            self.object.statsd.gauge('controller.agent.log.backlog|%s' % self.name, backlog_bytes)
+        self.object.statsd.gauge('controller.agent.log.lag|%s' % self.name, now - self.caught_up)
+
+    def report_drops(self):
+        """
+        Reports lines the tail lost before they were collected
+        """
+        if self.name is None:
+            return
+
+        for reason, count in self.tail.dropped().iteritems():
+            self.object.statsd.incr('controller.agent.log.dropped.%s|%s' % (reason, self.name), count)
+
+    def _sleep(self):
+        if self.backlog is not None:
+            # let other collectors run, then continue with the backlog
+            time.sleep(self.backlog_interval)
+        else:
+            super(NginxAccessLogsCollector, self)._sleep()
 
+    def parse(self, records):
+        """
+        Parses log records
+
+        :param records: [] of log records
+        :return: [] of parsed records (None for the ones that could not be parsed)
+        """
+        parsed_records = []
+        for line in records:
             try:
                 parsed = self.parser.parse(line)
             except:
                 context.log.debug('could not parse line %r' % line, exc_info=True)
                 parsed = None
+            parsed_records.append(parsed)
+        return parsed_records
+
+    def process(self, records, parsed_records=None):
+        """
+        Parses log records and collects metrics from them
+
+        :param records: [] of log records (multiline records are already joined)
+        :param parsed_records: [] of already parsed records (see parse)
+        """
+        if parsed_records is None:
+            parsed_records = self.parse(records)
 
+        for parsed in parsed_records:
             if not parsed:
                 continue
 
@@ -154,17 +460,69 @@ class NginxAccessLogsCollector(AbstractCollector):
                 self.request_malformed()
             else:
                 # try to match custom filters and collect log metrics with them
-                matched_filters = [filter for filter in self.filters if filter.match(parsed)]
+                matched_filters = self.filter_set.filters_for(self.filter_set.match(parsed))
                 super(NginxAccessLogsCollector, self).collect(parsed, matched_filters)
 
-        tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
-        context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
+    def merge(self, partial):
+        """
+        Adds metrics aggregated by a parse worker to the object's statsd
+
+        Series new in the current period go through statsd.admit(), just like values reported in-process.
+
+        :param partial: {} of statsd data of a parse worker
+        """
+        statsd = self.object.statsd
+
+        for metric_name, slots in partial.get('counter', {}).iteritems():
+            self.local_counters[metric_name] += sum(value for _, value in slots)
+
+        for metric_name, heavy_hitters in partial.get('top', {}).iteritems():
+            statsd.top(metric_name, heavy_hitters)
+
+        if 'histogram' in partial:
+            histograms = statsd.current['histogram']
+            for metric_name, counts in partial['histogram'].iteritems():
+                if metric_name in histograms:
+                    histograms[metric_name] = [a + b for a, b in zip(histograms[metric_name], counts)]
+                elif statsd.admit(metric_name):
+                    histograms[metric_name] = counts
+
+        for metric_type in ('timer', 'average'):
+            if metric_type in partial:
+                current = statsd.current[metric_type]
+                for metric_name, values in partial[metric_type].iteritems():
+                    if metric_name in current:
+                        current[metric_name].extend(values)
+                    elif statsd.admit(metric_name):
+                        current[metric_name] = values
+
+    def incr(self, metric_name, value=1):
+        """
+        Increments a local counter (see push_counters)
+
+        :param metric_name: str metric name
+        :param value: int value
+        """
+        self.local_counters[metric_name] += value
+
+    def push_counters(self):
+        """
+        Sends local counters to statsd
+        """
+        incr = self.object.statsd.incr
+        for metric_name, value in self.local_counters.iteritems():
+            incr(metric_name, value)
+        self.local_counters.clear()
+
+        for metric_name, heavy_hitters in self.local_top.iteritems():
+            self.object.statsd.top(metric_name, heavy_hitters)
+        self.local_top = {}
 
     def request_malformed(self):
         """
         nginx.http.request.malformed
         """
-        self.object.statsd.incr('nginx.http.request.malformed')
+        self.local_counters['nginx.http.request.malformed'] += 1
 
     def http_method(self, data, matched_filters=None):
         """
@@ -180,12 +538,14 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'request_method' in data:
-            method = data['request_method'].lower()
-            method = method if method in self.valid_http_methods else 'other'
-            metric_name = 'nginx.http.method.%s' % method
-            self.object.statsd.incr(metric_name)
+            metric_name = self.method_metrics.get(data['request_method'])
+            if metric_name is None:
+                method = data['request_method'].lower()
+                method = method if method in self.valid_http_methods else 'other'
+                metric_name = 'nginx.http.method.%s' % method
+            self.local_counters[metric_name] += 1
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
 
     def http_status(self, data, matched_filters=None):
         """
@@ -206,29 +566,14 @@ class NginxAccessLogsCollector(AbstractCollector):
         :param matched_filters: [] of matched filters
         """
         if 'status' in data:
-            metrics_to_populate = []
-            http_status = data['status']
-
-            # add separate metrics for specific 4xx and 5xx codes
-            if http_status.startswith('4'):
-                if http_status in ('403', '404'):
-                    metrics_to_populate.append('nginx.http.status.%s' % http_status)
-            elif http_status.startswith('5'):
-                if http_status in ('500', '502', '503', '504'):
-                    metrics_to_populate.append('nginx.http.status.%s' % http_status)
-
-            metrics_to_populate.append('nginx.http.status.%sxx' % http_status[0])
+            metrics_to_populate = self.status_metrics.get(data['status'])
+            if metrics_to_populate is None:
+                metrics_to_populate = http_status_metrics(data['status'])
 
             for metric_name in metrics_to_populate:
-                self.object.statsd.incr(metric_name)
+                self.local_counters[metric_name] += 1
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
-
-                if data['status'] == '499':
-                    metric_name = 'nginx.http.status.discarded'
-                    self.object.statsd.incr(metric_name)
-                    if matched_filters:
-                        self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                    self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
 
     def http_version(self, data, matched_filters=None):
         """
@@ -242,27 +587,16 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         if 'server_protocol' in data:
             proto = data['server_protocol']
-            if not proto.startswith('HTTP'):
-                return
-
-            version = proto.split('/')[-1]
-
-            # Ordered roughly by expected popularity to reduce number of calls to `startswith`
-            if version.startswith('1.1'):
-                suffix = '1_1'
-            elif version.startswith('2.0'):
-                suffix = '2'
-            elif version.startswith('1.0'):
-                suffix = '1_0'
-            elif version.startswith('0.9'):
-                suffix = '0_9'
+            if proto in self.version_metrics:
+                metric_name = self.version_metrics[proto]
             else:
-                suffix = version.replace('.', '_')
+                metric_name = http_version_metric(proto)
+                if metric_name is None:
+                    return
 
-            metric_name = 'nginx.http.v%s' % suffix
-            self.object.statsd.incr(metric_name)
+            self.local_counters[metric_name] += 1
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
 
     def request_length(self, data, matched_filters=None):
         """
@@ -286,9 +620,9 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         if 'body_bytes_sent' in data:
             metric_name, value = 'nginx.http.request.body_bytes_sent', data['body_bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+            self.local_counters[metric_name] += value
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, value, self.incr)
 
     def bytes_sent(self, data, matched_filters=None):
         """
@@ -299,9 +633,9 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         if 'bytes_sent' in data:
             metric_name, value = 'nginx.http.request.bytes_sent', data['bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+            self.local_counters[metric_name] += value
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, value, self.incr)
 
     def gzip_ration(self, data, matched_filters=None):
         """
@@ -331,9 +665,7 @@ class NginxAccessLogsCollector(AbstractCollector):
             metric_name, value = 'nginx.http.request.time', sum(data['request_time'])
             self.object.statsd.timer(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(self.create_parent_filters(matched_filters, parent_metric=metric_name),
-                                         metric_name, value,
-                                         self.object.statsd.timer)
+                self.count_parent_filters(matched_filters, metric_name, value)
 
     def upstreams(self, data, matched_filters=None):
         """
@@ -378,13 +710,17 @@ class NginxAccessLogsCollector(AbstractCollector):
         upstream_response = False
         if 'upstream_status' in data:
             for status in data['upstream_status']:  # upstream_status is parsed as a list
-                if status.isdigit():
-                    suffix = '%sxx' % status[0]
-                    metric_name = 'nginx.upstream.status.%s' % suffix
-                    upstream_response = True if suffix in ('2xx', '3xx') else False   # Set flag for upstream length processing
-                    self.object.statsd.incr(metric_name)
+                if status in self.upstream_status_metrics:
+                    status_metric = self.upstream_status_metrics[status]
+                else:
+                    status_metric = upstream_status_metric(status)
+
+                if status_metric is not None:
+                    # upstream_response is a flag for upstream length processing
+                    metric_name, upstream_response = status_metric
+                    self.local_counters[metric_name] += 1
                     if matched_filters:
-                        self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                        self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
 
         if upstream_response and 'upstream_response_length' in data:
             metric_name, value = 'nginx.upstream.response.length', data['upstream_response_length']
@@ -394,11 +730,7 @@ class NginxAccessLogsCollector(AbstractCollector):
 
         # gauges
         upstream_switches = None
-        for metric_name, key_name in {
-            'nginx.upstream.connect.time': 'upstream_connect_time',
-            'nginx.upstream.response.time': 'upstream_response_time',
-            'nginx.upstream.header.time': 'upstream_header_time'
-        }.iteritems():
+        for metric_name, key_name in self.upstream_timers:
             if key_name in data:
                 values = data[key_name]
 
@@ -410,52 +742,175 @@ class NginxAccessLogsCollector(AbstractCollector):
                 value = sum(values)
                 self.object.statsd.timer(metric_name, value)
                 if matched_filters:
-                    self.count_custom_filter(self.create_parent_filters(matched_filters, parent_metric=metric_name),
-                                             metric_name,
-                                             value, self.object.statsd.timer)
+                    self.count_parent_filters(matched_filters, metric_name, value)
 
         # log upstream switches
         metric_name, value = 'nginx.upstream.next.count', 0 if upstream_switches is None else upstream_switches
-        self.object.statsd.incr(metric_name, value)
+        self.local_counters[metric_name] += value
         if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+            self.count_custom_filter(matched_filters, metric_name, value, self.incr)
 
         # cache
         if 'upstream_cache_status' in data:
             cache_status = data['upstream_cache_status']
-            cache_status_lower = cache_status.lower()
-            if cache_status_lower in self.valid_cache_statuses:
-                metric_name = 'nginx.cache.%s' % cache_status_lower
-                self.object.statsd.incr(metric_name)
+            metric_name = self.cache_metrics.get(cache_status)
+            if metric_name is None:
+                cache_status_lower = cache_status.lower()
+                if cache_status_lower in self.valid_cache_statuses:
+                    metric_name = 'nginx.cache.%s' % cache_status_lower
+
+            if metric_name is not None:
+                self.local_counters[metric_name] += 1
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                    self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
 
         # log total upstream requests
         metric_name = 'nginx.upstream.request.count'
-        self.object.statsd.incr(metric_name)
+        self.local_counters[metric_name] += 1
         if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+            self.count_custom_filter(matched_filters, metric_name, 1, self.incr)
+
+    @classmethod
+    def create_peer_metrics(cls, peer):
+        """
+        :param peer: str upstream peer
+        :return: ({} of first digit of status -> counter name, () of timer names in upstream_timers order)
+        """
+        status_metrics = dict(
+            (digit, intern('nginx.upstream.peer.status.%sxx|%s' % (digit, peer))) for digit in '12345'
+        )
+        timer_metrics = tuple(
+            intern('%s|%s' % (metric_name.replace('nginx.upstream.', 'nginx.upstream.peer.'), peer))
+            for metric_name, _ in cls.upstream_timers
+        )
+        return status_metrics, timer_metrics
+
+    def upstream_peers(self, data, matched_filters=None):
+        """
+        nginx.upstream.peer.connect.time|<peer>
+        nginx.upstream.peer.header.time|<peer>
+        nginx.upstream.peer.response.time|<peer>
+        nginx.upstream.peer.status.1xx|<peer>
+        nginx.upstream.peer.status.2xx|<peer>
+        nginx.upstream.peer.status.3xx|<peer>
+        nginx.upstream.peer.status.4xx|<peer>
+        nginx.upstream.peer.status.5xx|<peer>
+
+        Peers are taken from $upstream_addr, statuses and times of the same position belong to the same peer.
+        Peers above the limit are counted as one "overflow" peer.
+
+        :param data: {} of parsed line
+        :param matched_filters: [] of matched filters
+        """
+        peers = data.get('upstream_addr')
+        if not peers:
+            return
+
+        count = len(peers)
+        statuses = data.get('upstream_status')
+        if statuses is not None and len(statuses) != count:
+            statuses = None  # can't tell which status belongs to which peer
+
+        timers = []
+        for index, (_, key_name) in enumerate(self.upstream_timers):
+            values = data.get(key_name)
+            if values is not None and len(values) == count:
+                timers.append((index, values))
+
+        for position, peer in enumerate(peers):
+            if peer == '-':
+                continue
+
+            metrics = self.peer_metrics.get(peer)
+            if metrics is None:
+                if len(self.peer_metrics) < self.peer_limit:
+                    metrics = self.peer_metrics[peer] = self.create_peer_metrics(peer)
+                else:
+                    if len(self.peer_metrics) == self.peer_limit:
+                        context.log.warn(
+                            '%s upstream peers limit (%s) reached, other peers are counted as "%s"' % (
+                                self.name, self.peer_limit, self.overflow_peer
+                            )
+                        )
+                        self.peer_metrics[self.overflow_peer] = self.overflow_peer_metrics
+                    metrics = self.overflow_peer_metrics
+            status_metrics, timer_metrics = metrics
+
+            if statuses is not None:
+                metric_name = status_metrics.get(statuses[position][:1])
+                if metric_name is not None:
+                    self.local_counters[metric_name] += 1
+
+            for index, values in timers:
+                self.object.statsd.timer(timer_metrics[index], values[position])
+
+    def top(self, data, matched_filters=None):
+        """
+        nginx.http.top.request_uri.<status class>|<uri>
+        nginx.http.top.remote_addr.<status class>|<address>
+        nginx.http.top.http_user_agent.<status class>|<user agent>
+        nginx.http.top.upstream_addr.<status class>|<peer>
+
+        :param data: {} of parsed line
+        :param matched_filters: [] of matched filters
+        """
+        status = data.get('status')
+        status_class = '%sxx' % status[0] if status else 'all'
+
+        for key in self.top_keys:
+            value = data.get(key)
+            if not value or value == '-':
+                continue
+
+            metric_name = self.top_metrics.get((key, status_class))
+            if metric_name is None:
+                metric_name = self.top_metrics[(key, status_class)] = 'nginx.http.top.%s.%s' % (key, status_class)
+
+            heavy_hitters = self.local_top.get(metric_name)
+            if heavy_hitters is None:
+                heavy_hitters = self.local_top[metric_name] = HeavyHitters(
+                    k=self.top_k, width=self.top_width, depth=self.top_depth
+                )
+
+            if isinstance(value, list):  # upstream_addr is parsed as a list
+                for item in value:
+                    if item != '-':
+                        heavy_hitters.add(item)
+            else:
+                heavy_hitters.add(value)
 
     @staticmethod
-    def create_parent_filters(original_filters, parent_metric):
+    def create_parent_filters(filters):
         """
         median, max, pctl95, and count are created in statsd.flush().  So if a
         filter on nginx.upstream.response.time.median is created, the filter metric
         should be truncated to nginx.upstream.response.time
 
-        :param original_filters:
-        :param truncated_metric:
-        :return:
+        :param filters: [] of filters
+        :return: {} of timer metric name -> {filter: full timer metric name for this filter}
         """
-        parent_filters = []
-        for original_filter in original_filters:
-            if parent_metric not in original_filter.metric:
-                continue
-            parent_filter = copy.deepcopy(original_filter)
-            parent_filter.metric = parent_metric
-            parent_filters.append(parent_filter)
+        parent_filters = {}
+        for parent_metric in NginxAccessLogsCollector.timer_metrics:
+            parent_filters[parent_metric] = dict(
+                (log_filter, '%s||%s' % (parent_metric, log_filter.filter_rule_id))
+                for log_filter in filters if parent_metric in log_filter.metric
+            )
         return parent_filters
 
+    def count_parent_filters(self, matched_filters, parent_metric, value):
+        """
+        Collect custom timer metric (see create_parent_filters)
+
+        :param matched_filters: [] of matched filters
+        :param parent_metric: str timer metric name
+        :param value: float value
+        """
+        filter_metrics = self.parent_filters[parent_metric]
+        if filter_metrics:
+            for log_filter in matched_filters:
+                if log_filter in filter_metrics:
+                    self.object.statsd.timer(filter_metrics[log_filter], value)
+
     @staticmethod
     def count_custom_filter(matched_filters, metric_name, value, method):
         """
@@ -469,5 +924,4 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         for log_filter in matched_filters:
             if log_filter.metric == metric_name:
-                full_metric_name = '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)
-                method(full_metric_name, value)
+                method(log_filter.metric_handle, value)
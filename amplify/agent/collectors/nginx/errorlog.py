@@ -4,7 +4,7 @@ from amplify.agent.objects.nginx.log.error import NginxErrorLogParser
 
 from amplify.agent.common.context import context
 from amplify.agent.pipelines.abstract import Pipeline
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.file import FileTail, save_offsets
 from amplify.agent.objects.nginx.config.config import ERROR_LOG_LEVELS
 
 __author__ = "Mike Belov"
@@ -52,5 +52,7 @@ class NginxErrorLogsCollector(AbstractCollector):
         tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
         context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
 
+        save_offsets()
+
     def error_log_parsed(self, error):
         self.object.statsd.incr(error)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import cPickle
+import hashlib
+import logging
+import multiprocessing
+import traceback
+
+import gevent
+from gevent.lock import Semaphore
+from gevent.socket import wait_read
+
+from amplify.agent.common.context import context
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+# this one is a process-wide pool (see get_parse_pool), False means parsing is done in-process
+PARSE_POOL = None
+
+
+class ShardObject(object):
+    """
+    Stand-in for an nginx object inside of a worker process: collectors write
+    to its statsd, which is then sent back to the parent as a partial aggregate
+    """
+    in_container = False
+
+    def __init__(self, filters):
+        from amplify.agent.data.statsd import StatsdClient
+        self.filters = filters
+        self.statsd = StatsdClient()
+        self.definition_hash = 'parse worker'
+
+
+def build_collector(spec):
+    """
+    Creates an access log collector in a worker process
+
+    :param spec: (log_format, tail name, [(filter data, metric, filter rule id)])
+    :return: NginxAccessLogsCollector
+    """
+    from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+    from amplify.agent.objects.nginx.filters import Filter
+    from amplify.agent.pipelines.abstract import Pipeline
+
+    log_format, tail_name, filters = spec
+    shard_object = ShardObject(
+        filters=[Filter(data=data, metric=metric, filter_rule_id=rule_id) for data, metric, rule_id in filters]
+    )
+    tail = Pipeline(name=tail_name) if tail_name else None
+    return NginxAccessLogsCollector(object=shard_object, log_format=log_format, tail=tail)
+
+
+def close_inherited_fds(keep):
+    """
+    Closes file descriptors a forked worker inherited from the agent (except stdio and "keep"):
+    sockets, log files, the other end of the pipe and the fds of the gevent hub
+
+    :param keep: int fd to keep open
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = xrange(3, 1024)
+
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def setup_worker(conn):
+    """
+    The worker is forked from the agent, so it first drops what it inherited: the gevent hub
+    (it only does blocking reads from the pipe), every fd but the pipe, logging (log files are closed)
+    and the parse pool (collectors of the worker parse in-process)
+
+    :param conn: multiprocessing Connection
+    """
+    global PARSE_POOL
+
+    gevent.get_hub().destroy(destroy_loop=True)
+    close_inherited_fds(keep=conn.fileno())
+    logging.disable(logging.CRITICAL)
+    PARSE_POOL = False
+
+
+def worker_loop(conn):
+    """
+    Main loop of a worker process: receives (key, spec, records), parses records
+    and sends back (True, statsd data) or (False, traceback)
+
+    Errors are sent back to the parent, which logs them.
+
+    :param conn: multiprocessing Connection
+    """
+    setup_worker(conn)
+    collectors = {}
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, IOError):
+            # parent has gone away
+            return
+
+        if message is None:
+            return
+
+        try:
+            key, spec, records = message
+            collector = collectors.get(key)
+            if collector is None:
+                if len(collectors) > ParsePool.max_shards:
+                    collectors.clear()  # forget collectors of removed/reloaded objects
+                collector = collectors[key] = build_collector(spec)
+
+            collector.process(records)
+            collector.push_counters()
+
+            # the series limit is applied by the parent (see NginxAccessLogsCollector.merge),
+            # so series admitted by the worker are forgotten with every partial
+            statsd = collector.object.statsd
+            partial = dict(statsd.current)
+            statsd.current.clear()
+            statsd.series.clear()
+            conn.send((True, partial))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+class ParseWorker(object):
+    """
+    Handle of a single worker process
+    """
+
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.lock = Semaphore()  # one request at a time, as the pipe is shared by all collectors of the shard
+        self.process = multiprocessing.Process(target=worker_loop, args=(child_conn,), name='amplify-parse-worker')
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def request(self, message):
+        """
+        Sends records to the worker and waits for the result.  Other greenlets run while the worker is busy,
+        a worker that doesn't answer in "timeout" seconds is given up (socket.timeout is raised).
+
+        :param message: (key, spec, records)
+        :return: (bool ok, statsd data or traceback)
+        """
+        with self.lock:
+            self.conn.send(message)
+            wait_read(self.conn.fileno(), timeout=self.timeout)
+            return self.conn.recv()  # EOFError if the worker died
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except (IOError, OSError):
+            pass
+        try:
+            self.process.terminate()
+            self.process.join(1)
+        except Exception:
+            pass
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.conn.close()
+        except (IOError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ParsePool(object):
+    """
+    Pool of worker processes that parse access log lines and pre-aggregate metrics.
+
+    Every log file is bound to one worker (sharding by file), so its collector is created in the
+    worker once and is reused by all following chunks. Collectors in the parent only merge
+    counters, timers and averages returned by workers into the object's statsd.
+
+    A worker that dies or doesn't answer in "timeout" seconds is killed and started again with the
+    next chunk, the chunk itself is parsed in-process.
+    """
+
+    # collectors kept in a worker before it starts from scratch
+    max_shards = 1000
+
+    def __init__(self, size, timeout=10.0):
+        self.size = size
+        self.timeout = timeout
+        self.workers = [None] * size
+
+    def _worker(self, index):
+        worker = self.workers[index]
+        if worker is not None and not worker.process.is_alive():
+            self._kill(index)
+            worker = None
+        if worker is None:
+            worker = self.workers[index] = ParseWorker(timeout=self.timeout)
+        return worker
+
+    def process(self, collector, records):
+        """
+        Parses records in a worker process
+
+        :param collector: NginxAccessLogsCollector
+        :param records: [] of log records
+        :return: {} of statsd data or None if records should be parsed in-process
+        """
+        key, spec = collector.shard
+        index = int(key, 16) % self.size
+
+        try:
+            ok, result = self._worker(index).request((key, spec, records))
+        except socket.timeout:
+            context.log.error('parse worker did not answer in %ss, restarting it and parsing in-process' % self.timeout)
+            self._kill(index)
+            return None
+        except Exception:
+            context.log.error('parse worker failed, parsing in-process')
+            context.log.debug('additional info:', exc_info=True)
+            self._kill(index)
+            return None
+
+        if not ok:
+            context.log.error('parse worker failed to process %s lines, parsing in-process' % len(records))
+            context.log.debug('additional info: %s' % result)
+            return None
+
+        return result
+
+    def _kill(self, index):
+        worker = self.workers[index]
+        self.workers[index] = None
+        if worker is not None:
+            worker.kill()
+
+    def stop(self):
+        for index, worker in enumerate(self.workers):
+            if worker is not None:
+                worker.stop()
+            self.workers[index] = None
+
+
+def shard_spec(collector):
+    """
+    Describes collector for building its copy in a worker process
+
+    :param collector: NginxAccessLogsCollector
+    :return: (str key, spec tuple)
+    """
+    spec = (
+        collector.parser.raw_format,
+        getattr(collector.tail, 'name', None),
+        [(f.original_data, f.metric, f.filter_rule_id) for f in collector.filters]
+    )
+    return hashlib.md5(cPickle.dumps(spec, 2)).hexdigest(), spec
+
+
+def get_parse_pool():
+    """
+    Returns process-wide parse pool or None if it's disabled ("log_workers" in [nginx] section)
+
+    :return: ParsePool or None
+    """
+    global PARSE_POOL
+
+    if PARSE_POOL is None:
+        PARSE_POOL = False
+        nginx_config = context.app_config.get('nginx', {})
+        workers = nginx_config.get('log_workers')
+        if workers and int(workers) > 0:
+            PARSE_POOL = ParsePool(int(workers), timeout=float(nginx_config.get('log_worker_timeout', 10.0)))
+
+    return PARSE_POOL or None
+
+
+def stop_parse_pool():
+    global PARSE_POOL
+
+    if PARSE_POOL:
+        PARSE_POOL.stop()
+    PARSE_POOL = None
@@ -10,6 +10,7 @@ from amplify.agent.common.context import context
 from amplify.agent.common.util import host
 from amplify.agent.common.util import subp
 from amplify.agent.collectors.abstract import AbstractMetricsCollector
+from amplify.agent.data.names import METRIC_NAMES
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -164,7 +165,7 @@ class SystemMetricsCollector(AbstractMetricsCollector):
                 if prev_stamp and new_value >= prev_value:
                     metric_name, value_divider, stat_func = description
                     delta_value = (new_value - prev_value) / value_divider
-                    metric_full_name = metric_name if disk == '__all__' else '%s|%s' % (metric_name, disk)
+                    metric_full_name = metric_name if disk == '__all__' else METRIC_NAMES.dimension(metric_name, disk)
                     stat_func(metric_full_name, delta_value)
 
                     if method == 'write_count':
@@ -184,7 +185,7 @@ class SystemMetricsCollector(AbstractMetricsCollector):
                         delta_value = (new_value - prev_value) / float(value_divider)
                     else:
                         delta_value = 0
-                    metric_full_name = metric_name if disk == '__all__' else '%s|%s' % (metric_name, disk)
+                    metric_full_name = metric_name if disk == '__all__' else METRIC_NAMES.dimension(metric_name, disk)
                     stat_func(metric_full_name, delta_value)
 
                 self.previous_counters[disk][method] = (new_stamp, new_value)
@@ -220,7 +221,7 @@ class SystemMetricsCollector(AbstractMetricsCollector):
 
                 if prev_stamp and new_value >= prev_value:
                     delta_value = new_value - prev_value
-                    metric_full_name = '%s|%s' % (metric, interface)
+                    metric_full_name = METRIC_NAMES.dimension(metric, interface)
                     self.object.statsd.incr(metric_full_name, delta_value)
 
                     # collect total values
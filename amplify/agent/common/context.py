@@ -163,7 +163,7 @@ class Context(Singleton):
 
     def _setup_app_listeners(self):
         from amplify.agent.common.util import net
-        self.listeners = set()
+        self.listeners = {}  # formatted address -> listener definition
 
         # get a list of listener names
         names = self.app_config.get('listeners', {}).get('keys', '').split(',')
@@ -178,10 +178,17 @@ class Context(Singleton):
                 listener_address = listener_definition.get('address')
                 # ...if there is an address...
                 if listener_address is not None:
-                    # ...try to format and save the ipv4 address into the context store.
+                    listener_address = listener_address.strip()
+                    # ...save unix socket addresses as is ("unix:/path", same as in nginx syslog directives)...
+                    if listener_address.startswith('unix:'):
+                        if len(listener_address) > len('unix:'):
+                            self.listeners[listener_address] = listener_definition
+                        continue
+
+                    # ...or try to format and save the ipv4 address into the context store.
                     try:
                         _, _, formatted_address = net.ipv4_address(address=listener_address, full_format=True)
-                        self.listeners.add(formatted_address)
+                        self.listeners[formatted_address] = listener_definition
                     except:
                         pass  # just ignore bad ipv4 definitions for now
 
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
 import hashlib
 import time
 
@@ -81,7 +80,8 @@ class EventdClient(CommonDataClient):
         if not self.current:
             return {'object': self.object.definition}
 
-        delivery = copy.deepcopy(self.current)
+        # swap buffers, events of the detached one are not referenced anymore
+        delivery = self.current
         self.current = {}
 
         return {
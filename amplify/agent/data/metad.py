@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
 from collections import defaultdict
 
 from amplify.agent.data.abstract import CommonDataClient
@@ -25,7 +24,10 @@ class MetadClient(CommonDataClient):
 
     def flush(self):
         if self.current:
-            delivery = copy.deepcopy(self.current)
-            delivery.update(agent=self.context.version)
+            # meta dicts are owned (and updated) by collectors, a queued payload gets its own copies of them
+            delivery = dict(
+                (key, dict(value) if isinstance(value, dict) else value) for key, value in self.current.iteritems()
+            )
+            delivery['agent'] = self.context.version
             self.current = defaultdict(dict)
             return delivery
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class MetricName(object):
+    """
+    Metric name with all the names StatsdClient.flush() sends it under.
+
+    A dimension suffix ("||<filter>" or "|<dimension>") goes after the .count/.max/.median/.pctl95 part.
+    """
+    __slots__ = ('name', 'counter', 'gauge', 'count', 'max', 'median', 'pctl95')
+
+    def __init__(self, name):
+        self.name = intern(name)
+
+        base, suffix = name, ''
+        suffix_index = name.find('|')
+        if suffix_index > 0:
+            base, suffix = name[:suffix_index], name[suffix_index:]
+
+        self.counter = 'C|%s' % name
+        self.gauge = 'G|%s' % name
+        self.count = 'C|%s.count%s' % (base, suffix)
+        self.max = 'G|%s.max%s' % (base, suffix)
+        self.median = 'G|%s.median%s' % (base, suffix)
+        self.pctl95 = 'G|%s.pctl95%s' % (base, suffix)
+
+
+class MetricNames(object):
+    """
+    Process-wide registry of metric names.
+
+    Names are interned and get integer handles, so collectors can keep a handle instead of building
+    a name again for every value; StatsdClient accepts handles wherever it accepts names.
+    Registered names are never removed, so the registry is limited by max_size - above it names are
+    not registered (handle() returns the name itself) and their variants are built on every flush.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.names = []  # handle -> MetricName
+        self.handles = {}  # name -> handle
+        self.metrics = {}  # name -> MetricName
+        self.dimensions = {}  # (name, dimension, separator) -> handle
+
+    def __len__(self):
+        return len(self.names)
+
+    def handle(self, name):
+        """
+        :param name: str metric name
+        :return: int handle or str name if the registry is full
+        """
+        handle = self.handles.get(name)
+        if handle is None:
+            if len(self.names) >= self.max_size:
+                return name
+            handle = self.handles[name] = len(self.names)
+            metric = self.metrics[name] = MetricName(name)
+            self.names.append(metric)
+        return handle
+
+    def dimension(self, name, dimension, separator='|'):
+        """
+        Handle of a name with a dimension ("system.net.bytes_sent|eth0", "nginx.http.status.2xx||42"),
+        built only once for every combination
+
+        :param name: str base metric name
+        :param dimension: str dimension (disk, interface, filter rule id)
+        :param separator: str "|" or "||" for filters
+        :return: int handle or str name if the registry is full
+        """
+        key = (name, dimension, separator)
+        handle = self.dimensions.get(key)
+        if handle is None:
+            handle = self.handle('%s%s%s' % (name, separator, dimension))
+            if isinstance(handle, int):
+                self.dimensions[key] = handle
+        return handle
+
+    def name(self, handle):
+        """
+        :param handle: int handle or str name
+        :return: str name
+        """
+        if isinstance(handle, int):
+            return self.names[handle].name
+        return handle
+
+    def get(self, name):
+        """
+        Prebuilt variants of a registered name.  Unregistered names are not registered here (flush gets every
+        series, including short-lived dimensions), their variants are built for this call only.
+
+        :param name: str name or int handle
+        :return: MetricName
+        """
+        metric = self.metrics.get(name)
+        if metric is not None:
+            return metric
+
+        if name.__class__ is int:
+            return self.names[name]
+
+        return MetricName(name)
+
+
+# this one is a process-wide registry
+METRIC_NAMES = MetricNames()
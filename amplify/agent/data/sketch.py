@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+import math
+from array import array
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class TimerSketch(object):
+    """
+    Mergeable quantile sketch with relative error guarantee (DDSketch).
+
+    Positive values are counted in logarithmic buckets: bucket i holds values in (gamma^(i-1), gamma^i]
+    where gamma = (1 + accuracy) / (1 - accuracy), so any quantile is estimated with a relative error
+    of at most "accuracy". Count, sum, min and max are exact.
+
+    Memory doesn't depend on the number of samples: the number of buckets is bounded by the range
+    of values (~800 buckets for 1ms..1h with 1% accuracy) and by max_buckets, after which the lowest
+    buckets are collapsed.
+
+    Supports append()/extend()/len() so it can be used in place of a list of samples.
+    """
+
+    max_buckets = 2048
+
+    # values below this are counted as zeros
+    min_value = 1e-9
+
+    def __init__(self, accuracy=0.01, values=None):
+        self.accuracy = accuracy
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+        if values:
+            self.extend(values)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        """
+        Adds a sample
+
+        :param value: int/float value
+        """
+        if value > self.min_value:
+            key = int(math.ceil(math.log(value) / self.log_gamma))
+            buckets = self.buckets
+            if key in buckets:
+                buckets[key] += 1
+            else:
+                buckets[key] = 1
+                if len(buckets) > self.max_buckets:
+                    self._collapse()
+        else:
+            self.zeros += 1
+
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def extend(self, values):
+        """
+        Adds samples from an iterable or merges another sketch
+
+        :param values: iterable of values or TimerSketch
+        """
+        if isinstance(values, TimerSketch):
+            self.merge(values)
+        else:
+            for value in values:
+                self.append(value)
+
+    def merge(self, other):
+        """
+        Adds all samples of another sketch (with the same accuracy)
+
+        :param other: TimerSketch
+        """
+        if not other.count:
+            return
+
+        buckets = self.buckets
+        for key, count in other.buckets.iteritems():
+            buckets[key] = buckets.get(key, 0) + count
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+
+    def _collapse(self):
+        """
+        Merges the lowest buckets so that there are not more than max_buckets of them
+        """
+        keys = sorted(self.buckets)
+        excess = keys[:len(keys) - self.max_buckets]
+        target = keys[len(excess)]
+        for key in excess:
+            self.buckets[target] += self.buckets.pop(key)
+
+    def values_at_ranks(self, ranks):
+        """
+        Estimates values of the samples with given ranks (as if samples were sorted)
+
+        :param ranks: [] of int 0-based ranks in ascending order
+        :return: [] of float values
+        """
+        result = []
+        ranks = iter(ranks)
+        rank = next(ranks, None)
+
+        # zeros go first
+        while rank is not None and rank < self.zeros:
+            result.append(self.min)
+            rank = next(ranks, None)
+
+        seen = self.zeros
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            while rank is not None and rank < seen:
+                # the value that has the same relative error to both ends of the bucket
+                value = 2.0 * self.gamma ** key / (self.gamma + 1.0)
+                result.append(min(max(value, self.min), self.max))
+                rank = next(ranks, None)
+
+            if rank is None:
+                break
+
+        return result
+
+    def summary(self):
+        """
+        Same stats as StatsdClient.flush() calculates for a sorted list of samples
+
+        :return: (mean, count, max, median, pctl95)
+        """
+        length = self.count
+        pctl95_rank = length - int(round(length * .05))
+        if pctl95_rank == length:
+            pctl95_rank = 0  # values[-0]
+        median_ranks = [length // 2] if length % 2 else [length // 2 - 1, length // 2]
+
+        ranks = sorted(set(median_ranks + [pctl95_rank]))
+        values = dict(zip(ranks, self.values_at_ranks(ranks)))
+
+        median = sum(values[rank] for rank in median_ranks) / float(len(median_ranks))
+        return self.sum / float(length), length, self.max, median, values[pctl95_rank]
+
+
+class HeavyHitters(object):
+    """
+    Approximate top-k of the most frequent keys in fixed memory.
+
+    Every key is counted in a count-min sketch (depth rows of width counters), so its count is
+    overestimated by at most ~2 * total / width with high probability. Only the k keys with the
+    highest estimates are kept along with their estimates; k is small, so the smallest one is found
+    by a scan rather than kept in a heap.
+
+    Sketches of the same size can be merged (counters are added and candidates are re-estimated).
+    """
+
+    def __init__(self, k=10, width=512, depth=4):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for _ in xrange(depth)]
+        self.total = 0
+        self.candidates = {}  # key -> estimated count
+        self.min_key = None
+
+    def __len__(self):
+        return self.total
+
+    def _indexes(self, key):
+        # double hashing: rows use h, h + step, h + 2 * step...
+        h = hash(key)
+        step = (h >> 16) | 1
+        width = self.width
+        return [(h + i * step) % width for i in xrange(self.depth)]
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def add(self, key, count=1):
+        """
+        Counts a key
+
+        :param key: str key
+        :param count: int number of occurrences
+        """
+        h = hash(key)
+        step = (h >> 16) | 1
+        width = self.width
+        estimate = None
+        for row in self.rows:  # same as _indexes(), inlined
+            index = h % width
+            value = row[index] + count
+            row[index] = value
+            if estimate is None or value < estimate:
+                estimate = value
+            h += step
+        self.total += count
+
+        candidates = self.candidates
+        if key in candidates:
+            candidates[key] = estimate
+            if key == self.min_key:
+                self._find_min()
+        elif len(candidates) < self.k:
+            candidates[key] = estimate
+            if self.min_key is None or estimate < candidates[self.min_key]:
+                self.min_key = key
+        elif self.k and estimate > candidates[self.min_key]:
+            del candidates[self.min_key]
+            candidates[key] = estimate
+            self._find_min()
+
+    def _find_min(self):
+        candidates = self.candidates
+        self.min_key = min(candidates, key=candidates.get) if candidates else None
+
+    def merge(self, other):
+        """
+        Adds all counts of another sketch (of the same width and depth)
+
+        :param other: HeavyHitters
+        """
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError('cannot merge sketches of different size')
+
+        for row, other_row in zip(self.rows, other.rows):
+            for index, value in enumerate(other_row):
+                if value:
+                    row[index] += value
+        self.total += other.total
+
+        keys = set(self.candidates)
+        keys.update(other.candidates)
+        estimates = sorted(((self.estimate(key), key) for key in keys), reverse=True)
+        self.candidates = dict((key, estimate) for estimate, key in estimates[:self.k])
+        self._find_min()
+
+    def top(self):
+        """
+        :return: [] of (key, estimated count), the most frequent first
+        """
+        return sorted(self.candidates.iteritems(), key=lambda item: item[1], reverse=True)
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
-import copy
 import time
+from bisect import bisect_left
 
 from amplify.agent.common.util.math import median
+from amplify.agent.data.eventd import WARNING
+from amplify.agent.data.names import METRIC_NAMES
+from amplify.agent.data.sketch import TimerSketch
 from collections import defaultdict
 
 __author__ = "Mike Belov"
@@ -13,6 +16,14 @@ __email__ = "dedm@nginx.com"
 
 
 class StatsdClient(object):
+    # timers that also get histogram buckets if "timer_buckets" are configured (with any "|" suffix)
+    histogram_timers = frozenset([
+        'nginx.http.request.time',
+        'nginx.upstream.connect.time',
+        'nginx.upstream.header.time',
+        'nginx.upstream.response.time',
+    ])
+
     def __init__(self, address=None, port=None, interval=None, object=None):
         # Import context as a class object to avoid circular import on statsd.  This could be refactored later.
         from amplify.agent.common.context import context
@@ -25,6 +36,53 @@ class StatsdClient(object):
         self.current = defaultdict(dict)
         self.delivery = defaultdict(dict)
 
+        # timers keep all samples ("exact") or quantile sketches ("sketch", see TimerSketch)
+        agent_config = context.app_config.get('agent', {}) if context.app_config is not None else {}
+        if agent_config.get('timers', 'exact') == 'sketch':
+            self.timer_accuracy = float(agent_config.get('timer_accuracy', 0.01))
+        else:
+            self.timer_accuracy = None
+
+        # sorted upper bounds of histogram buckets, values above the last one go to the "inf" bucket
+        buckets = agent_config.get('timer_buckets')
+        if buckets:
+            self.timer_buckets = sorted(float(bound) for bound in str(buckets).split(','))
+            self.bucket_names = [('%g' % bound).replace('.', '_') for bound in self.timer_buckets] + ['inf']
+        else:
+            self.timer_buckets = None
+        self.histogram_names = {}  # timer name -> bool, see histogram_timers
+
+        # series with a dimension ("metric||filter", "metric|sda" etc) are limited by "max_series",
+        # first come first served, series not seen during a whole flush period are forgotten
+        max_series = int(agent_config.get('max_series', 10000))
+        self.max_series = max_series if max_series > 0 else None
+        self.series = set()
+        self.series_overflow = False  # the limit was reached at least once
+
+    def admit(self, metric_name):
+        """
+        Checks that a metric that is new in the current period fits into the series limit
+
+        :param metric_name: metric name
+        :return: bool False if values of the metric should be dropped
+        """
+        if self.max_series is None or '|' not in metric_name or metric_name in self.series:
+            return True
+
+        if len(self.series) < self.max_series:
+            self.series.add(metric_name)
+            return True
+
+        self.incr('controller.agent.series.dropped')
+        if not self.series_overflow:
+            self.series_overflow = True
+            message = 'too many metric series (limit is %s), values of new series are dropped' % self.max_series
+            self.context.log.warn('%s: %s' % (getattr(self.object, 'definition_hash', None), message))
+            eventd = getattr(self.object, 'eventd', None)
+            if eventd is not None:
+                eventd.event(level=WARNING, message=message, onetime=True)
+        return False
+
     def latest(self, metric_name, value, stamp=None):
         """
         Stores the most recent value of a gauge
@@ -33,9 +91,15 @@ class StatsdClient(object):
         :param value: metric value
         :param stamp: timestamp (current timestamp will be used if this is not specified)
         """
+        if metric_name.__class__ is int:
+            metric_name = METRIC_NAMES.names[metric_name].name  # handle of a registered name
+
         timestamp = stamp or int(time.time())
         gauges = self.current['gauge']
-        if metric_name not in gauges or timestamp > gauges[metric_name][0][0]:
+        if metric_name not in gauges:
+            if self.admit(metric_name):
+                gauges[metric_name] = [(timestamp, value)]
+        elif timestamp > gauges[metric_name][0][0]:
             gauges[metric_name] = [(timestamp, value)]
 
     def average(self, metric_name, value):
@@ -45,9 +109,12 @@ class StatsdClient(object):
         :param metric_name:  metric name
         :param value:  metric value
         """
+        if metric_name.__class__ is int:
+            metric_name = METRIC_NAMES.names[metric_name].name  # handle of a registered name
+
         if metric_name in self.current['average']:
             self.current['average'][metric_name].append(value)
-        else:
+        elif self.admit(metric_name):
             self.current['average'][metric_name] = [value]
 
     def timer(self, metric_name, value):
@@ -60,24 +127,58 @@ class StatsdClient(object):
         Sort the data set by value from highest to lowest and discard the highest 5% of the sorted samples.
         The next highest sample is the 95th percentile value for the data set.
 
+        In "sketch" mode samples are not stored, percentiles are estimated with TimerSketch.
+
         :param metric_name: metric name
         :param value: metric value
         """
+        if metric_name.__class__ is int:
+            metric_name = METRIC_NAMES.names[metric_name].name  # handle of a registered name
+
         if metric_name in self.current['timer']:
             self.current['timer'][metric_name].append(value)
+        elif not self.admit(metric_name):
+            return
+        elif self.timer_accuracy:
+            self.current['timer'][metric_name] = TimerSketch(accuracy=self.timer_accuracy, values=[value])
         else:
             self.current['timer'][metric_name] = [value]
 
+        if self.timer_buckets is not None:
+            histogram = self.histogram_names.get(metric_name)
+            if histogram is None:
+                histogram = self.histogram_names[metric_name] = metric_name.split('|')[0] in self.histogram_timers
+            if histogram:
+                self.histogram(metric_name, value)
+
+    def histogram(self, metric_name, value):
+        """
+        Counts a value in a fixed bucket (see timer_buckets)
+
+        :param metric_name: metric name
+        :param value: metric value
+        """
+        histograms = self.current['histogram']
+        if metric_name in histograms:
+            counts = histograms[metric_name]
+        else:
+            counts = histograms[metric_name] = [0] * (len(self.timer_buckets) + 1)
+        counts[bisect_left(self.timer_buckets, value)] += 1
+
     def incr(self, metric_name, value=None, rate=None, stamp=None):
         """
         Simple counter with rate
 
+        Without rate (the common case) the value is added to the current slot in place,
+        the timestamp is taken only when the metric appears in the current period.
+
         :param metric_name: metric name
         :param value: metric value
         :param rate: rate
         :param stamp: timestamp (current timestamp will be used if this is not specified)
         """
-        timestamp = stamp or int(time.time())
+        if metric_name.__class__ is int:
+            metric_name = METRIC_NAMES.names[metric_name].name  # handle of a registered name
 
         if value is None:
             value = 1
@@ -88,25 +189,28 @@ class StatsdClient(object):
             )
             return
 
+        counters = self.current['counter']
+        slots = counters.get(metric_name)
+
         # new metric
-        if metric_name not in self.current['counter']:
-            self.current['counter'][metric_name] = [[timestamp, value]]
+        if slots is None:
+            if self.admit(metric_name):
+                counters[metric_name] = [[stamp or int(time.time()), value]]
             return
 
         # metric exists
-        slots = self.current['counter'][metric_name]
-        last_stamp, last_value = slots[-1]
-
-        # if rate is set then check it's time
         if self.interval and rate:
+            # if rate is set then check it's time
+            timestamp = stamp or int(time.time())
+            last_stamp = slots[-1][0]
             sample_duration = self.interval * rate
-            # write to current slot
             if timestamp < last_stamp + sample_duration:
-                self.current['counter'][metric_name][-1] = [last_stamp, last_value + value]
+                # write to current slot
+                slots[-1][1] += value
             else:
-                self.current['counter'][metric_name].append([last_stamp, value])
+                slots.append([last_stamp, value])
         else:
-            self.current['counter'][metric_name][-1] = [last_stamp, last_value + value]
+            slots[-1][1] += value
 
     def object_status(self, metric_name, value=1, stamp=None):
         """
@@ -118,6 +222,18 @@ class StatsdClient(object):
         timestamp = stamp or int(time.time())
         self.current['gauge'][metric_name] = [(timestamp, value)]
 
+    def top(self, metric_name, heavy_hitters):
+        """
+        Adds keys counted by a collector to the top-k of a metric
+
+        :param metric_name: metric name
+        :param heavy_hitters: HeavyHitters
+        """
+        if metric_name in self.current['top']:
+            self.current['top'][metric_name].merge(heavy_hitters)
+        else:
+            self.current['top'][metric_name] = heavy_hitters
+
     def gauge(self, metric_name, value, delta=False, prefix=False, stamp=None):
         """
         Gauge
@@ -126,6 +242,9 @@ class StatsdClient(object):
         :param delta: metric delta (applicable only if we have previous values)
         :param stamp: timestamp (current timestamp will be used if this is not specified)
         """
+        if metric_name.__class__ is int:
+            metric_name = METRIC_NAMES.names[metric_name].name  # handle of a registered name
+
         timestamp = stamp or int(time.time())
 
         if metric_name in self.current['gauge']:
@@ -135,35 +254,47 @@ class StatsdClient(object):
             else:
                 new_value = value
             self.current['gauge'][metric_name].append((timestamp, new_value))
-        else:
+        elif self.admit(metric_name):
             self.current['gauge'][metric_name] = [(timestamp, value)]
 
     def flush(self):
         if not self.current:
             return {'object': self.object.definition}
 
+        # swap buffers, the detached one is transformed in place (timer samples are sorted etc.)
         results = {}
-        delivery = copy.deepcopy(self.current)
+        delivery = self.current
         self.current = defaultdict(dict)
 
+        if self.max_series is not None:
+            # keep the series that got values, so they are not displaced by new ones
+            self.series = set(
+                metric_name for values in delivery.itervalues() for metric_name in values if '|' in metric_name
+            )
+
         # histogram
         if 'timer' in delivery:
             timers = {}
             timestamp = int(time.time())
             for metric_name, metric_values in delivery['timer'].iteritems():
                 if len(metric_values):
-                    metric_values.sort()
-                    length = len(metric_values)
-                    timers['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
-                    filter_suffix = ""
-                    filter_suffix_index = metric_name.find("||")
-                    if filter_suffix_index > 0:
-                        filter_suffix = metric_name[filter_suffix_index:]
-                        metric_name = metric_name[:filter_suffix_index]
-                    timers['C|%s.count%s' % (metric_name, filter_suffix)] = [[timestamp, length]]
-                    timers['G|%s.max%s' % (metric_name, filter_suffix)] = [[timestamp, metric_values[-1]]]
-                    timers['G|%s.median%s' % (metric_name, filter_suffix)] = [[timestamp, median(metric_values, presorted=True)]]
-                    timers['G|%s.pctl95%s' % (metric_name, filter_suffix)] = [[timestamp, metric_values[-int(round(length * .05))]]]
+                    if isinstance(metric_values, TimerSketch):
+                        mean, length, max_value, median_value, pctl95_value = metric_values.summary()
+                    else:
+                        metric_values.sort()
+                        length = len(metric_values)
+                        mean = sum(metric_values) / float(length)
+                        max_value = metric_values[-1]
+                        median_value = median(metric_values, presorted=True)
+                        pctl95_value = metric_values[-int(round(length * .05))]
+
+                    # all names are prebuilt, "||<filter>" or "|<dimension>" suffix goes after .max/.median etc.
+                    names = METRIC_NAMES.get(metric_name)
+                    timers[names.gauge] = [[timestamp, mean]]
+                    timers[names.count] = [[timestamp, length]]
+                    timers[names.max] = [[timestamp, max_value]]
+                    timers[names.median] = [[timestamp, median_value]]
+                    timers[names.pctl95] = [[timestamp, pctl95_value]]
             results['timer'] = timers
 
         # counters
@@ -178,10 +309,31 @@ class StatsdClient(object):
 
                 # Condense the list of lists 'v' into a list of a single element.  Remember that we are using lists
                 # instead of tuples because we need mutability during self.incr().
-                counters['C|%s' % k] = [[last_stamp, total_value]]
+                counters[METRIC_NAMES.get(k).counter] = [[last_stamp, total_value]]
 
             results['counter'] = counters
 
+        # histogram buckets are sent as counters "<metric>.bucket.<upper bound>"
+        if 'histogram' in delivery:
+            counters = results.setdefault('counter', {})
+            timestamp = int(time.time())
+            for metric_name, counts in delivery['histogram'].iteritems():
+                suffix = ''
+                suffix_index = metric_name.find('|')
+                if suffix_index > 0:
+                    suffix = metric_name[suffix_index:]
+                    metric_name = metric_name[:suffix_index]
+                for bucket_name, count in zip(self.bucket_names, counts):
+                    counters['C|%s.bucket.%s%s' % (metric_name, bucket_name, suffix)] = [[timestamp, count]]
+
+        # top-k keys are sent as counters "<metric>|<key>"
+        if 'top' in delivery:
+            counters = results.setdefault('counter', {})
+            timestamp = int(time.time())
+            for metric_name, heavy_hitters in delivery['top'].iteritems():
+                for key, count in heavy_hitters.top():
+                    counters['C|%s|%s' % (metric_name, key)] = [[timestamp, count]]
+
         # gauges
         if 'gauge' in delivery:
             gauges = {}
@@ -193,7 +345,7 @@ class StatsdClient(object):
                     total_value += value
 
                 # Condense list of tuples 'v' into a list of a single tuple using an average value.
-                gauges['G|%s' % k] = [(last_stamp, float(total_value)/len(v))]
+                gauges[METRIC_NAMES.get(k).gauge] = [(last_stamp, float(total_value)/len(v))]
             results['gauge'] = gauges
 
         # avg
@@ -203,10 +355,10 @@ class StatsdClient(object):
             for metric_name, metric_values in delivery['average'].iteritems():
                 if len(metric_values):
                     length = len(metric_values)
-                    averages['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
+                    averages[METRIC_NAMES.get(metric_name).gauge] = [[timestamp, sum(metric_values) / float(length)]]
             results['average'] = averages
 
         return {
-            'metrics': copy.deepcopy(results),
+            'metrics': results,
             'object': self.object.definition
         }
@@ -2,6 +2,8 @@
 import re
 import copy
 
+from amplify.agent.data.names import METRIC_NAMES
+
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
 __license__ = ""
@@ -16,6 +18,8 @@ class Filter(object):
     def __init__(self, data=None, metric=None, filter_rule_id=None):
         self.metric = metric
         self.filter_rule_id = filter_rule_id
+        # "metric||filter_rule_id" name of values counted for this filter
+        self.metric_handle = METRIC_NAMES.dimension(metric, filter_rule_id, '||') if metric else None
         self.filename = None
         self.filenamematch = None
         self.data = {}
@@ -88,3 +92,135 @@ class Filter(object):
             return True
         else:
             return False
+
+
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+class FilterSet(object):
+    """
+    Compiled set of filters that matches all of them against a parsed line at once.
+
+    Conditions are grouped by key, so every distinct key/regex pair is evaluated once per line:
+    - plain string conditions (values that are not valid regexes) are looked up in a dict
+    - regexes without special chars (re.match with them is a prefix check) are looked up
+      in a dict per prefix length
+    - other regexes are evaluated once for all filters that use them
+
+    match() returns a bitset: bit N is set if self.filters[N] matches.
+    """
+
+    # matched filter lists kept by filters_for()
+    max_cached_masks = 1024
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.all_mask = (1 << len(self.filters)) - 1
+        self.keys = []  # [(key, filters mask, unmatched mask, equality group, prefix groups, regexes)]
+        self._matched = {0: []}
+
+        conditions = {}
+        for index, log_filter in enumerate(self.filters):
+            bit = 1 << index
+            for key, value in log_filter.data.iteritems():
+                negated = log_filter._negated_conditions[key]
+                conditions.setdefault(key, []).append((value, negated, bit))
+
+        for key, key_conditions in conditions.iteritems():
+            key_mask = 0
+            unmatched = 0  # positive conditions that never match
+            equals = {}  # value -> [positive mask, negative mask]
+            prefixes = {}  # length -> {prefix -> [positive mask, negative mask]}
+            regexes = {}  # (pattern, flags) -> [compiled regex, positive mask, negative mask]
+
+            for value, negated, bit in key_conditions:
+                key_mask |= bit
+                if isinstance(value, RE_TYPE):
+                    if not value.flags & ~re.UNICODE and not REGEX_SPECIAL_CHARS.intersection(value.pattern):
+                        masks = prefixes.setdefault(len(value.pattern), {}).setdefault(value.pattern, [0, 0])
+                        masks[1 if negated else 0] |= bit
+                    else:
+                        entry = regexes.setdefault((value.pattern, value.flags), [value, 0, 0])
+                        entry[2 if negated else 1] |= bit
+                elif isinstance(value, str):
+                    masks = equals.setdefault(value, [0, 0])
+                    masks[1 if negated else 0] |= bit
+                elif not negated:
+                    unmatched |= bit
+
+            self.keys.append((
+                key,
+                key_mask,
+                unmatched,
+                self._group(equals),
+                [(length, self._group(group)) for length, group in sorted(prefixes.iteritems())],
+                [tuple(entry) for entry in regexes.itervalues()]
+            ))
+
+    @staticmethod
+    def _group(masks_by_value):
+        """
+        :return: ({value: (positive mask, negative mask)}, positive mask of all values)
+        """
+        positive = 0
+        group = {}
+        for value, (positive_mask, negative_mask) in masks_by_value.iteritems():
+            group[value] = (positive_mask, negative_mask)
+            positive |= positive_mask
+        return group, positive
+
+    def match(self, parsed):
+        """
+        Matches all filters against a parsed line
+
+        :param parsed: {} of parsed line
+        :return: int bitset of matched filters
+        """
+        mask = self.all_mask
+
+        for key, key_mask, unmatched, (equals, equals_positive), prefixes, regexes in self.keys:
+            if not mask & key_mask:
+                continue
+
+            # if the key isn't in parsed, all conditions on it fail
+            if key not in parsed:
+                mask &= ~key_mask
+                if not mask:
+                    return 0
+                continue
+
+            value = str(parsed[key])
+            failed = unmatched
+
+            if equals:
+                # positive conditions fail unless the value equals to them, negative ones fail if it does
+                positive, negative = equals.get(value, (0, 0))
+                failed |= (equals_positive & ~positive) | negative
+
+            for length, (group, group_positive) in prefixes:
+                positive, negative = group.get(value[:length], (0, 0))
+                failed |= (group_positive & ~positive) | negative
+
+            for regex, positive, negative in regexes:
+                if regex.match(value):
+                    failed |= negative
+                else:
+                    failed |= positive
+
+            mask &= ~failed
+            if not mask:
+                return 0
+
+        return mask
+
+    def filters_for(self, mask):
+        """
+        :param mask: int bitset returned by match()
+        :return: [] of matched filters
+        """
+        matched = self._matched.get(mask)
+        if matched is None:
+            matched = [log_filter for index, log_filter in enumerate(self.filters) if mask >> index & 1]
+            if len(self._matched) < self.max_cached_masks:
+                self._matched[mask] = matched
+        return matched
@@ -17,6 +17,24 @@ __email__ = "dedm@nginx.com"
 REQUEST_RE = re.compile(r'(?P<request_method>[A-Z]+) (?P<request_uri>/.*) (?P<server_protocol>.+)')
 
 
+def parse_time_value(value):
+    """
+    Converts raw value of a time variable (e.g. "0.120, 0.001") to a list of floats
+
+    :param value: str raw value
+    :return: [] of floats
+    """
+    array_value = []
+    for x in value.replace(' ', '').split(','):
+        x = float(x)
+        # workaround for an old nginx bug with time. ask lonerr@ for details
+        if x > 10000000:
+            continue
+        else:
+            array_value.append(x)
+    return array_value
+
+
 class NginxAccessLogParser(object):
     """
     Nginx access log parser
@@ -61,10 +79,11 @@ class NginxAccessLogParser(object):
         'upstream_status'
     ]
 
-    def __init__(self, raw_format=None):
+    def __init__(self, raw_format=None, needed_keys=None):
         """
         Takes raw format and generates regex
         :param raw_format: raw log format
+        :param needed_keys: iterable of keys to extract (all keys if None)
         """
         self.raw_format = self.combined_format if raw_format is None \
             else raw_format
@@ -72,7 +91,130 @@ class NginxAccessLogParser(object):
         self.keys, self.trie, self.non_key_patterns, self.first_value_is_key = \
             decompose_format(self.raw_format, full=True)
 
-    def parse(self, line):
+        self.needed_keys = None
+        self.parse_source = None
+        self.compile(needed_keys)
+
+    def compile(self, needed_keys=None):
+        """
+        Replaces generic parsing with a routine specialized for the log format
+
+        :param needed_keys: iterable of keys to extract (all keys if None)
+        """
+        self.needed_keys = set(needed_keys) if needed_keys is not None else None
+        self.parse_source = self.generate_parse_source()
+        if self.parse_source is not None:
+            namespace = {
+                'parse_time_value': parse_time_value,
+                'str': str,
+                'int': int,
+                'float': float,
+            }
+            exec(compile(self.parse_source, '<log_format %r>' % self.raw_format, 'exec'), namespace)
+            self.parse = namespace['parse']
+        else:
+            self.parse = self.parse_generic
+
+    def generate_parse_source(self):
+        """
+        Generates the source of a parse function specialized for the log format:
+        the split sequence is unrolled, every key gets its own cast, time and
+        comma separated keys get dedicated converters and the request split is
+        inlined.  Output is identical to parse_generic().
+
+        If needed_keys is set, values of other keys are skipped without being
+        sliced or casted.  The rest of the line is still matched against the
+        format, so truncated or malformed lines are rejected just like by
+        parse_generic().
+
+        :return: str source of "parse(line)" or None if format can't be compiled
+        """
+        keys_count = len(self.keys)
+
+        # number of values produced by splitting on non-key patterns
+        split_count = len(self.non_key_patterns) - (0 if self.first_value_is_key else 1)
+
+        # weird formats (where some keys never get a value) are left to the generic parser
+        if not keys_count or keys_count > split_count + 1:
+            return None
+
+        # the last occurrence of a key wins, just like dict(zip(keys, values))
+        value_indexes = dict((key, i) for i, key in enumerate(self.keys))
+
+        keys = []
+        for key in self.keys:
+            if key in keys:
+                continue
+            if self.needed_keys is not None and key not in self.needed_keys:
+                continue
+            keys.append(key)
+
+        needed_indexes = set(value_indexes[key] for key in keys)
+
+        lines = ['def parse(line):', '    pos = 0']
+
+        # unrolled split sequence
+        for i, pattern in enumerate(self.non_key_patterns):
+            index = i if self.first_value_is_key else i - 1
+            if index in needed_indexes:
+                lines.extend([
+                    '    end = line.index(%r, pos)' % pattern,
+                    '    v%d = line[pos:end]' % index,
+                    '    pos = end + %d' % len(pattern),
+                ])
+            else:
+                lines.append('    pos = line.index(%r, pos) + %d' % (pattern, len(pattern)))
+        if split_count in needed_indexes:
+            lines.append('    v%d = line[pos:]' % split_count)
+
+        lines.append("    result = {'malformed': False}")
+
+        for key in keys:
+            func = self.common_variables[key][1] if key in self.common_variables else self.default_variable[1]
+            lines.extend([
+                '    try:',
+                '        value = %s(v%d)' % (func.__name__, value_indexes[key]),
+                '    except ValueError:',
+                '        value = 0',
+            ])
+
+            time_var = key.endswith('_time')
+            if time_var:
+                lines.extend([
+                    "    if value not in ('', '-'):",
+                    '        value = parse_time_value(value)',
+                    '        if value:',
+                    '            result[%r] = value' % key,
+                ])
+
+            if key in self.comma_separated_keys:
+                lines.extend([
+                    "    if ',' in value:",
+                    "        result[%r] = value.replace(' ', '').split(',')" % key,
+                    '    else:',
+                    '        result[%r] = [value]' % key,
+                ])
+            elif not time_var and key != 'malformed':
+                lines.append('    result[%r] = value' % key)
+
+        if 'request' in keys:
+            lines.extend([
+                '    try:',
+                "        method, uri, proto = result['request'].split(' ')",
+                '    except Exception:',
+                "        result['malformed'] = True",
+                '    else:',
+                "        result['request_method'] = method",
+                "        result['request_uri'] = uri",
+                "        result['server_protocol'] = proto",
+                '        if len(method) < 3:',
+                "            result['malformed'] = True",
+            ])
+
+        lines.append('    return result')
+        return '\n'.join(lines) + '\n'
+
+    def parse_generic(self, line):
         """
         Parses the line and if there are some special fields - parse them too
         For example we can get HTTP method and HTTP version from request
@@ -80,6 +222,8 @@ class NginxAccessLogParser(object):
         The difference between this and above is that this one uses split
         mechanic rather than trie matching direclty.
 
+        This is used for formats that can't be compiled by generate_parse_source().
+
         :param line: log line
         :return: dict with parsed info
         """
@@ -126,14 +270,7 @@ class NginxAccessLogParser(object):
                     time_var = True
                     # skip empty vars
                     if value not in ('', '-'):
-                        array_value = []
-                        for x in value.replace(' ', '').split(','):
-                            x = float(x)
-                            # workaround for an old nginx bug with time. ask lonerr@ for details
-                            if x > 10000000:
-                                continue
-                            else:
-                                array_value.append(x)
+                        array_value = parse_time_value(value)
                         if array_value:
                             result[key] = array_value
 
@@ -11,8 +11,8 @@ from amplify.agent.data.eventd import INFO, WARNING
 from amplify.agent.objects.abstract import AbstractObject
 from amplify.agent.objects.nginx.binary import nginx_v
 from amplify.agent.objects.nginx.filters import Filter
-from amplify.agent.pipelines.syslog import SyslogTail
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.syslog import SyslogTail, DEFAULT_TAG
+from amplify.agent.pipelines.shared import open_tail
 
 
 __author__ = "Mike Belov"
@@ -264,17 +264,26 @@ class NginxObject(AbstractObject):
         tail = None
         try:
             if name.startswith('syslog'):
-                address_bucket = name.split(',', 1)[0]
-                host, port, address = net.ipv4_address(
-                    address=address_bucket.split('=')[1], full_format=True, silent=True
-                )
-                # Right now we assume AFNET address/port...e.g. no support for unix sockets
-
-                if address in context.listeners:
-                    port = int(port)  # socket requires integer port
-                    tail = SyslogTail(address=(host, port))
+                address_bucket, _, params = name.partition(',')
+                server = address_bucket.split('=', 1)[1]
+
+                # messages are routed by tag, so many objects can share a listener
+                params = dict(param.split('=', 1) for param in params.split(',') if '=' in param)
+                tag = params.get('tag', DEFAULT_TAG)
+
+                if server.startswith('unix:'):
+                    # UNIX datagram socket, the listener creates the socket file
+                    if server in context.listeners:
+                        permissions = context.listeners[server].get('permissions')
+                        tail = SyslogTail(address=server[len('unix:'):], tag=tag, permissions=permissions)
+                else:
+                    host, port, address = net.ipv4_address(address=server, full_format=True, silent=True)
+
+                    if address in context.listeners:
+                        port = int(port)  # socket requires integer port
+                        tail = SyslogTail(address=(host, port), tag=tag)
             else:
-                tail = FileTail(name)
+                tail = open_tail(name)
         except Exception as e:
             context.log.error(
                 'failed to initialize pipeline for "%s" due to %s (maybe has no rights?)' % (name, e.__class__.__name__)
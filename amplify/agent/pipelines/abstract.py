@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from itertools import islice
 
 
 __author__ = "Grant Hulegaard"
@@ -8,11 +9,27 @@ __maintainer__ = "Grant Hulegaard"
 __email__ = "grant.hulegaard@nginx.com"
 
 
+def chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most "size" items
+
+    :param iterable: iterable
+    :param size: int max length of a list
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Pipeline(object):
     """
     Abstract object that provides a common API for passing data for parsing to collectors.  Pipelines should return
     iterables or be iterables themselves.
     """
+    chunk_lines = 1000
 
     def __init__(self, name='pipeline'):
         self.name = name
@@ -28,6 +45,18 @@ class Pipeline(object):
     def next(self):
         return self.__next__()
 
+    def chunks(self):
+        """Yields lists of lines, so collectors can process them in batches"""
+        return chunked(self, self.chunk_lines)
+
+    def backlog(self):
+        """Returns the number of unread bytes or None if it's unknown"""
+        return None
+
+    def dropped(self):
+        """Returns {reason: number of lines lost since the previous call}, empty if the pipeline doesn't lose lines"""
+        return {}
+
     # This is a Pipeline API requirement
     def stop(self):
         """As collectors stop, pipelines should too."""
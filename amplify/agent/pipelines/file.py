@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
 import time
+from itertools import chain
 from os import stat
 
 from amplify.agent.common.context import context
 
 from amplify.agent.pipelines.abstract import Pipeline
+from amplify.agent.pipelines.inotify import get_watcher
 
 
 __author__ = "Mike Belov"
@@ -17,6 +22,141 @@ __email__ = "dedm@nginx.com"
 # this one is used to store offset between objects' reloads
 OFFSET_CACHE = {}
 
+# this one is used to store offsets between agent restarts (see get_offset_store)
+OFFSET_STORE = None
+
+
+class OffsetStore(object):
+    """
+    Durable storage of FileTail offsets.
+
+    Offsets are kept in memory and written to disk atomically (temporary file + fsync + rename) by save().
+    Every path is stored along with device and inode, so a file replaced while the agent
+    was not running is read from the beginning rather than from a stale offset.
+
+    Entries of files that were deleted or replaced are pruned on save, so the store doesn't grow
+    with every rotated file (a tail adds the new file back with its next read).
+    """
+
+    # don't write the file more often than this (seconds), unless forced
+    save_interval = 1.0
+
+    def __init__(self, filename, max_catchup=None):
+        """
+        :param filename: str path to the store file
+        :param max_catchup: int max number of bytes to read after restart (None for no limit)
+        """
+        self.filename = filename
+        self.max_catchup = max_catchup
+        self.offsets = {}
+        self.dirty = False
+        self.last_save = 0
+        self.load()
+
+    @staticmethod
+    def _key(path):
+        """
+        Paths are stored as str, json loads them as unicode
+        """
+        return path.encode('utf-8') if isinstance(path, unicode) else path
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.offsets = dict((self._key(path), tuple(entry)) for path, entry in json.load(f).iteritems())
+        except IOError:
+            self.offsets = {}
+        except ValueError:
+            context.log.error('failed to load log offsets from "%s", file is broken' % self.filename)
+            context.log.debug('additional info:', exc_info=True)
+            self.offsets = {}
+
+    def get(self, path, dev, ino):
+        """
+        Returns stored offset for a file
+
+        :param path: str file path
+        :param dev: int st_dev of the file
+        :param ino: int st_ino of the file
+        :return: int offset, 0 if the file was replaced or None if it's unknown
+        """
+        path = self._key(path)
+        if path not in self.offsets:
+            return None
+
+        stored_dev, stored_ino, offset = self.offsets[path]
+        if (stored_dev, stored_ino) != (dev, ino):
+            return 0
+        return offset
+
+    def update(self, path, dev, ino, offset):
+        self.offsets[self._key(path)] = (dev, ino, offset)
+        self.dirty = True
+
+    def prune(self):
+        """
+        Removes entries of files that don't exist anymore or were replaced by other files
+        """
+        for path, (dev, ino, _) in self.offsets.items():
+            try:
+                st = stat(path)
+            except OSError:
+                del self.offsets[path]
+                continue
+            if (st.st_dev, st.st_ino) != (dev, ino):
+                del self.offsets[path]
+
+    def save(self, force=False):
+        """
+        Writes all updated offsets at once
+        """
+        if not self.dirty:
+            return
+
+        now = time.time()
+        if not force and now < self.last_save + self.save_interval:
+            return
+
+        self.last_save = now
+        self.prune()
+        dirname = os.path.dirname(self.filename) or '.'
+        try:
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.offsets')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.offsets, f)
+                f.flush()
+                os.fsync(f.fileno())  # otherwise the renamed file may be empty after a crash
+            os.rename(tmp_filename, self.filename)
+            self.dirty = False
+        except (IOError, OSError):
+            context.log.error('failed to save log offsets to "%s"' % self.filename)
+            context.log.debug('additional info:', exc_info=True)
+
+
+def get_offset_store():
+    """
+    Returns the offset store set up in [nginx] section of agent config or None if it's not configured
+    """
+    global OFFSET_STORE
+
+    nginx_config = context.app_config.get('nginx', {})
+    filename = nginx_config.get('log_offsets')
+    if not filename:
+        return None
+
+    if OFFSET_STORE is None or OFFSET_STORE.filename != filename:
+        max_catchup = nginx_config.get('log_max_catchup')
+        OFFSET_STORE = OffsetStore(filename, max_catchup=int(max_catchup) if max_catchup else None)
+    return OFFSET_STORE
+
+
+def save_offsets():
+    """
+    Saves offsets of all tails to the offset store (if there is one)
+    """
+    if OFFSET_STORE is not None:
+        OFFSET_STORE.save()
+
 
 class FileTail(Pipeline):
     """
@@ -27,25 +167,48 @@ class FileTail(Pipeline):
     Copyright (C) 2011 Brad Greenlee <brad@footle.org>
 
     https://raw.githubusercontent.com/bgreenlee/pygtail/master/pygtail/core.py
+
+    If inotify is available the file is touched only after it was modified, moved or
+    replaced (see pipelines.inotify), otherwise it is checked for rotation on every read.
     """
 
+    # bytes read from the file at once
+    chunk_size = 1024 * 1024
+
     def __init__(self, filename):
         super(FileTail, self).__init__(name='file:%s' % filename)
         self.filename = filename
         self._fh = None
+        self._buffer = ''  # partial trailing line, carried over to the next read
+        self._lines = None  # lines iterator of next()
+        self.offset_store = get_offset_store()
+
+        # save inode to determine rotations
+        self._inode = None
+        self._dev = None
+        self._update_inode()
 
-        # open a file and seek to the end
+        # open a file and seek to the end (or to the offset stored before agent restart)
         if self.filename not in OFFSET_CACHE:
             with open(self.filename, "r") as f:
-                f.seek(0, 2)
-                self._offset = OFFSET_CACHE[self.filename] = f.tell()
+                self._offset = OFFSET_CACHE[self.filename] = self._initial_offset(f)
+            if self.offset_store is not None:
+                self.offset_store.update(self.filename, self._dev, self._inode, self._offset)
         else:
             self._offset = OFFSET_CACHE[self.filename]
 
-        # save inode to determine rotations
-        self._inode = self._st_ino()
+        # watch for changes (or poll if inotify is not available)
+        self.watch = None
+        self.watcher = get_watcher()
+        if self.watcher is not None:
+            try:
+                self.watch = self.watcher.add(self.filename)
+            except:
+                context.log.error('failed to watch "%s", it will be polled' % self.filename)
+                context.log.debug('additional info:', exc_info=True)
 
     def __del__(self):
+        self._unwatch()
         try:
             if self._filehandle():
                 self._fh.close()
@@ -53,14 +216,113 @@ class FileTail(Pipeline):
             pass
 
     def __iter__(self):
-        self._filehandle()
-        return self
+        return chain.from_iterable(self.chunks())
+
+    def __next__(self):
+        """
+        Returns the next unread line, raises StopIteration at the end of the file
+        """
+        if self._lines is None:
+            self._lines = iter(self)
+
+        try:
+            return next(self._lines)
+        except StopIteration:
+            self._lines = None  # lines written later are read by the next call
+            raise
+
+    def chunks(self):
+        """
+        Yields lists of unread lines, one list per chunk read from the file.
+        The offset is updated before every yield.
+        """
+        if self.watch is None:
+            self._filehandle()
+        else:
+            self.watcher.read_events()
+            if not self.watch.pending():
+                # nothing has happened to the file since the last read
+                return
+
+            check_rotation = self.watch.rotated
+            self.watch.modified = self.watch.rotated = False
+            self._filehandle(check_rotation=check_rotation)
+
+        while True:
+            lines = self._read_lines()
+            if lines is None:
+                # we've reached the end of the file
+                break
+
+            self._update_offset()
+            if lines:
+                yield lines
+
+    def backlog(self):
+        """
+        Returns the number of bytes written to the file but not read yet
+        """
+        try:
+            if not self._is_closed():
+                size = os.fstat(self._fh.fileno()).st_size
+            else:
+                size = stat(self.filename).st_size
+        except OSError:
+            return 0
+        return max(size - self._offset, 0)
+
+    def stop(self):
+        self._unwatch()
+        if self.offset_store is not None:
+            self.offset_store.save(force=True)
+
+    def _initial_offset(self, fh):
+        """
+        Finds the offset to start reading from: the end of the file or the offset stored
+        in the offset store, but not more than "max_catchup" bytes back from the end.
+
+        :param fh: file handle
+        :return: int offset
+        """
+        fh.seek(0, 2)
+        size = fh.tell()
+
+        offset = None
+        if self.offset_store is not None:
+            offset = self.offset_store.get(self.filename, self._dev, self._inode)
+
+        if offset is None:
+            return size
+        elif offset > size:
+            # the file was truncated while agent was not running
+            offset = 0
+
+        max_catchup = self.offset_store.max_catchup
+        if max_catchup is not None and size - offset > max_catchup:
+            context.log.info(
+                'skipping %s bytes of "%s" written while agent was not running' % (
+                    size - offset - max_catchup, self.filename
+                )
+            )
+            # skip to the beginning of the first line within the limit
+            fh.seek(size - max_catchup - 1)
+            fh.readline()
+            offset = fh.tell()
+
+        return offset
+
+    def _unwatch(self):
+        if getattr(self, 'watch', None) is not None:
+            self.watcher.remove(self.watch)
+            self.watch = None
 
     def _st_ino(self):
         return stat(self.filename).st_ino
 
     def _update_inode(self):
-        self._inode = self._st_ino()
+        st = stat(self.filename)
+        self._inode = st.st_ino
+        self._dev = st.st_dev
 
     def _file_was_rotated(self):
         """
@@ -89,30 +351,23 @@ class FileTail(Pipeline):
 
         # check for copytruncate
         # it will use the same file so inode will stay the same
-        file_truncated = False
-        if new_inode == self._inode and self.filename in OFFSET_CACHE:
-            with open(self.filename, 'r') as temp_fh:
-                temp_fh.seek(0, 2)
-                if temp_fh.tell() < OFFSET_CACHE[self.filename]:
-                    # this means the file is smaller than previously cached
-                    # so file must have been truncated
-                    file_truncated = True
-
-        if file_truncated:
-            return True
-        return new_inode != self._inode
+        if new_inode == self._inode:
+            return self._file_was_truncated()
+        return True
 
-    def __next__(self):
+    def _file_was_truncated(self):
         """
-        Return the next line in the file, updating the offset.
+        Checks that file is smaller than previously cached offset (copytruncate)
+        :return: bool
         """
-        try:
-            line = self._get_next_line()
-        except StopIteration:
-            # we've reached the end of the file;
-            self._update_offset()
-            raise
-        return line
+        if self.filename not in OFFSET_CACHE:
+            return False
+
+        if not self._is_closed():
+            size = os.fstat(self._fh.fileno()).st_size
+        else:
+            size = stat(self.filename).st_size
+        return size < OFFSET_CACHE[self.filename]
 
     def readlines(self):
         """
@@ -125,12 +380,17 @@ class FileTail(Pipeline):
             return True
         return self._fh.closed
 
-    def _filehandle(self):
+    def _filehandle(self, check_rotation=True):
         """
         Return a filehandle to the file being tailed, with the position set
         to the current offset.
+
+        :param check_rotation: bool False if the file is known to stay in place (only truncation is checked then)
         """
-        file_was_rotated = self._file_was_rotated()
+        if check_rotation:
+            file_was_rotated = self._file_was_rotated()
+        else:
+            file_was_rotated = self._file_was_truncated()
 
         if not self._fh or self._is_closed() or file_was_rotated:
             if not self._is_closed():
@@ -142,13 +402,41 @@ class FileTail(Pipeline):
 
             self._fh = open(self.filename, "r")
             self._fh.seek(self._offset)
+            self._buffer = ''
+
+        if self.watch is not None and (file_was_rotated or self.watch.wd is None):
+            # follow the new file
+            try:
+                self.watcher.rewatch(self.watch)
+            except OSError:
+                context.log.debug('failed to watch "%s"' % self.filename, exc_info=True)
         return self._fh
 
     def _update_offset(self):
-        self._offset = OFFSET_CACHE[self.filename] = self._filehandle().tell()
+        """
+        Stores the offset of the first unread byte (partial trailing line is considered unread)
+        """
+        self._offset = OFFSET_CACHE[self.filename] = self._fh.tell() - len(self._buffer)
+        if self.offset_store is not None:
+            self.offset_store.update(self.filename, self._dev, self._inode, self._offset)
 
-    def _get_next_line(self):
-        line = self._fh.readline()
-        if not line:
-            raise StopIteration
-        return line.rstrip('\n\r')
+    def _read_lines(self):
+        """
+        Reads a chunk of the file and splits it into complete lines
+
+        :return: [] of lines (may be empty if no complete line was read) or None at the end of the file
+        """
+        data = self._fh.read(self.chunk_size)
+        if not data:
+            return None
+
+        if self._buffer:
+            data = self._buffer + data
+
+        lines = data.split('\n')
+        self._buffer = lines.pop()
+
+        if '\r' in data:
+            lines = [line.rstrip('\r') for line in lines]
+
+        return lines
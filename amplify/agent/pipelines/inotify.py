@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from collections import defaultdict
+
+from amplify.agent.common.context import context
+from amplify.agent.common.util.configtypes import boolean
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+FILE_MASK = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_MASK = IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# this one is a process-wide watcher (see get_watcher), False means inotify is not available
+WATCHER = None
+
+
+class FileWatch(object):
+    """
+    Change flags for a single watched file.
+
+    "modified" is set when something was written to (or truncated) the file,
+    "rotated" is set when the file was moved/deleted or a new file appeared in its place.
+    Both flags are set initially, so the file gets fully checked at least once.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.dirname, self.basename = os.path.split(self.filename)
+        self.wd = None
+        self.dir_wd = None
+        self.modified = True
+        self.rotated = True
+
+    def pending(self):
+        return self.modified or self.rotated
+
+
+class InotifyWatcher(object):
+    """
+    Non-blocking inotify instance shared by all FileTails.
+
+    Watches every tailed file and its directory. Events are drained by read_events() which
+    is cheap (a single read on a non-blocking descriptor) and only raises flags of FileWatch objects.
+    """
+
+    read_size = 64 * 1024
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.file_watches = defaultdict(list)  # wd -> [FileWatch]
+        self.dir_watches = defaultdict(list)  # wd -> [FileWatch]
+
+    def _add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '%s: %s' % (os.strerror(err), path))
+        return wd
+
+    def _rm_watch(self, watches, wd, watch):
+        if watch in watches.get(wd, ()):
+            watches[wd].remove(watch)
+            if not watches[wd]:
+                del watches[wd]
+                # the watch may be already gone (IN_IGNORED), so errors are ignored here
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def add(self, filename):
+        """
+        Starts watching a file and its directory
+
+        :param filename: str path
+        :return: FileWatch
+        """
+        watch = FileWatch(filename)
+        watch.dir_wd = self._add_watch(watch.dirname, DIR_MASK)
+        self.dir_watches[watch.dir_wd].append(watch)
+        try:
+            self.rewatch(watch)
+        except:
+            self.remove(watch)
+            raise
+        return watch
+
+    def rewatch(self, watch):
+        """
+        Moves file watch to the file currently found by the path (used after rotations)
+        """
+        if watch.wd is not None:
+            self._rm_watch(self.file_watches, watch.wd, watch)
+        watch.wd = None
+        watch.wd = self._add_watch(watch.filename, FILE_MASK)
+        self.file_watches[watch.wd].append(watch)
+
+    def remove(self, watch):
+        if watch.wd is not None:
+            self._rm_watch(self.file_watches, watch.wd, watch)
+            watch.wd = None
+        if watch.dir_wd is not None:
+            self._rm_watch(self.dir_watches, watch.dir_wd, watch)
+            watch.dir_wd = None
+
+    def read_events(self):
+        """
+        Drains pending events and updates the flags of affected watches
+        """
+        while True:
+            try:
+                data = os.read(self.fd, self.read_size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+
+            if not data:
+                return
+
+            self.process_events(data)
+
+    def process_events(self, data):
+        pos, size = 0, len(data)
+        while pos + EVENT_HEADER.size <= size:
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + name_len].rstrip('\0')
+            pos += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # some events were lost, so everything has to be checked
+                for watches in self.file_watches.values():
+                    for watch in watches:
+                        watch.modified = watch.rotated = True
+            elif wd in self.file_watches:
+                for watch in self.file_watches[wd]:
+                    watch.modified = True
+                    if mask & (IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED):
+                        watch.rotated = True
+                if mask & IN_IGNORED:
+                    # kernel has removed this watch itself
+                    for watch in self.file_watches.pop(wd):
+                        watch.wd = None
+            elif wd in self.dir_watches:
+                for watch in self.dir_watches[wd]:
+                    if name == watch.basename:
+                        watch.modified = watch.rotated = True
+                if mask & IN_IGNORED:
+                    for watch in self.dir_watches.pop(wd):
+                        watch.dir_wd = None
+                        watch.modified = watch.rotated = True
+
+
+def load_libc():
+    """
+    :return: ctypes libc with inotify functions or None if inotify is not supported
+    """
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def get_watcher():
+    """
+    Returns process-wide inotify watcher or None if it's disabled or not available
+    (in this case FileTails fall back to polling)
+
+    :return: InotifyWatcher or None
+    """
+    global WATCHER
+
+    if WATCHER is None:
+        WATCHER = False
+
+        if not boolean(context.app_config.get('nginx', {}).get('log_inotify', True)):
+            return None
+
+        try:
+            libc = load_libc()
+            if libc is not None:
+                WATCHER = InotifyWatcher(libc)
+        except:
+            context.log.error('failed to initialize inotify, log files will be polled')
+            context.log.debug('additional info:', exc_info=True)
+
+    return WATCHER or None
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import deque
+from itertools import chain
+
+from amplify.agent.common.context import context
+from amplify.agent.pipelines.abstract import Pipeline
+from amplify.agent.pipelines.file import FileTail
+
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+# this one is a process-wide registry of files being read, real path -> SharedFile (see open_tail)
+SHARED_FILES = {}
+
+
+class SharedChunk(list):
+    """
+    List of lines read once and passed to every subscriber of a file.
+
+    "parsed" is a cache for parse results, so collectors with the same parser
+    can parse the lines only once (see NginxAccessLogsCollector.collect_chunks)
+    """
+
+    def __init__(self, lines):
+        super(SharedChunk, self).__init__(lines)
+        self.parsed = {}
+
+
+class SharedFile(object):
+    """
+    Single FileTail of a physical file and the subscribers that get chunks read from it
+    """
+
+    def __init__(self, filename):
+        self.path = os.path.realpath(filename)
+        self.tail = FileTail(filename)
+        self.subscribers = []
+        self.reader = None  # current chunks iterator of the tail
+
+    def identity(self):
+        return self.tail._dev, self.tail._inode
+
+    def read_chunk(self):
+        """
+        Reads the next chunk of the file and queues it for every subscriber
+
+        :return: bool False if there's nothing to read
+        """
+        if self.reader is None:
+            self.reader = self.tail.chunks()
+
+        lines = next(self.reader, None)
+        if lines is None:
+            self.reader = None
+            return False
+
+        chunk = SharedChunk(lines)
+        for subscriber in self.subscribers:
+            subscriber.enqueue(chunk)
+        return True
+
+    def subscribe(self, filename):
+        subscriber = SharedTail(self, filename)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+        if not self.subscribers:
+            # the offset stays in OFFSET_CACHE, so a restarted object continues from the same place
+            if SHARED_FILES.get(self.path) is self:
+                del SHARED_FILES[self.path]
+            self.reader = None
+            self.tail.stop()
+
+
+class SharedTail(Pipeline):
+    """
+    Subscription to a shared file: yields every chunk of the file once, no matter
+    how many other collectors read the same file
+
+    Chunks read for other subscribers wait in "pending" until this one reads them.  A subscriber that reads
+    much less often than the others would hold everything the file produces, so pending is limited by
+    log_max_pending lines: the oldest chunks are dropped and counted (see dropped)
+    """
+
+    def __init__(self, shared, filename):
+        super(SharedTail, self).__init__(name='file:%s' % filename)
+        self.filename = filename
+        self.shared = shared
+        self.pending = deque()  # chunks read by the file but not by this subscriber
+        self.pending_lines = 0
+        self.max_pending = int(context.app_config.get('nginx', {}).get('log_max_pending', 100000))
+        self.overflows = 0  # lines dropped from pending since the previous dropped() call
+        self.stopped = False
+
+    def __iter__(self):
+        return chain.from_iterable(self.chunks())
+
+    def chunks(self):
+        while not self.stopped:
+            if not self.pending and not self.shared.read_chunk():
+                return
+            chunk = self.pending.popleft()
+            self.pending_lines -= len(chunk)
+            yield chunk
+
+    def enqueue(self, chunk):
+        """
+        Queues a chunk read by the shared file, the oldest chunks are dropped above max_pending lines
+        (the newest one is always kept)
+
+        :param chunk: SharedChunk
+        """
+        self.pending.append(chunk)
+        self.pending_lines += len(chunk)
+        while self.max_pending and self.pending_lines > self.max_pending and len(self.pending) > 1:
+            dropped = len(self.pending.popleft())
+            self.pending_lines -= dropped
+            self.overflows += dropped
+
+    def dropped(self):
+        """
+        Lines dropped from pending because this subscriber didn't keep up with the others
+
+        :return: {} of reason -> int number of lines
+        """
+        if not self.overflows:
+            return {}
+
+        result = {'overflow': self.overflows}
+        self.overflows = 0
+        return result
+
+    def readlines(self):
+        return [line for line in self]
+
+    def backlog(self):
+        unread = self.shared.tail.backlog()
+        for chunk in self.pending:
+            unread += sum(len(line) + 1 for line in chunk)
+        return unread
+
+    def stop(self):
+        if not getattr(self, 'stopped', True):
+            self.stopped = True
+            self.pending.clear()
+            self.pending_lines = 0
+            self.shared.unsubscribe(self)
+
+
+def open_tail(filename):
+    """
+    Subscribes to a log file. Files are looked up by real path and by device and inode,
+    so a file referenced by several objects (or via different paths) is read only once.
+
+    :param filename: str path
+    :return: SharedTail
+    """
+    path = os.path.realpath(filename)
+    shared = SHARED_FILES.get(path)
+
+    if shared is None:
+        st = os.stat(path)
+        for candidate in SHARED_FILES.itervalues():
+            if candidate.identity() == (st.st_dev, st.st_ino):
+                shared = candidate
+                break
+        else:
+            shared = SHARED_FILES[path] = SharedFile(filename)
+            context.log.debug('opened shared tail for "%s"' % filename)
+
+    return shared.subscribe(filename)
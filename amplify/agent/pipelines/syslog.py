@@ -1,17 +1,24 @@
 """
-Asyncore implementation of a syslog interface.  Adapted from "Tiny Syslog Server in Python" (
-https://gist.github.com/marcelom/4218010) using Asyncore (https://docs.python.org/2/library/asyncore.html).  Some
-inspiration for asyncore implementation derived from pymotw (https://pymotw.com/2/asyncore/).
+Gevent implementation of a syslog interface.  Originally adapted from "Tiny Syslog Server in Python" (
+https://gist.github.com/marcelom/4218010).
 
-SyslogTail spawns coroutine which in turns spawns an asyncore implemented syslog server and handler/cache and returns
-the received messages when iterated.
+SyslogTail spawns coroutine which in turns runs a syslog server and handler/cache and returns the received messages
+when iterated.  The server waits for the socket to become readable in the gevent hub and then drains every pending
+datagram at once, so the kernel socket buffer doesn't overflow between wakeups.
+
+One server can serve several SyslogTails: messages are routed to the tail with the same syslog tag, so one listener
+address can be used by many nginx instances or vhosts (access_log syslog:server=...,tag=...).
 """
 # -*- coding: utf-8 -*-
-import copy
-import asyncore
+import os
+import stat
+import errno
 import socket
 from collections import deque
 
+import gevent
+from gevent import socket as gsocket
+from gevent.greenlet import GreenletExit
 from threading import current_thread
 from amplify.agent.common.util.threads import spawn
 
@@ -31,53 +38,276 @@ __email__ = "grant.hulegaard@nginx.com"
 
 SYSLOG_ADDRESSES = set()
 
+# address -> SyslogListener shared by SyslogTails with different tags
+SYSLOG_LISTENERS = {}
+
+# tag of nginx syslog messages when access_log syslog:... has no "tag=" (the nginx default)
+DEFAULT_TAG = 'nginx'
+
+# /proc files with per socket drop counters of the kernel
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
 
 class AmplifyAddresssAlreadyInUse(AmplifyException):
     description = "Couldn't start socket listener because address already in use"
 
 
-class SyslogServer(asyncore.dispatcher):
-    """Simple socket server that creates a socket and listens for and caches UDP packets"""
+def parse_rfc3164(data):
+    """
+    Finds the tag and the message of an RFC 3164 syslog message by index, without splitting the whole datagram, e.g.
+    "<190>Jan  1 00:00:00 hostname nginx: message" -> ("nginx", "message")
 
-    def __init__(self, cache, address, chunk_size=8192):
-        # Explicitly passed shared cache object
-        self.cache = cache
+    Timestamp and hostname are optional (python SysLogHandler doesn't send them), so the tag is the last word
+    before the first ": ".  A "[pid]" after the tag is skipped.
 
-        # Custom constants
-        self.chunk_size = chunk_size
+    :param data: str datagram
+    :return: (str tag, str message) or None if the datagram is not a syslog message
+    """
+    if data[:1] != '<':
+        return None
+
+    start = data.find('>', 1, 5)  # PRI is up to 3 digits
+    if start == -1:
+        return None
+
+    colon = data.find(': ', start)
+    if colon == -1:
+        return None
+
+    tag_start = data.rfind(' ', start, colon) + 1 or start + 1
+    tag_end = colon
+    if data[colon - 1] == ']':
+        bracket = data.rfind('[', tag_start, colon)
+        if bracket != -1:
+            tag_end = bracket
+
+    return data[tag_start:tag_end], data[colon + 2:].rstrip()
+
+
+class SyslogServer(object):
+    """
+    Simple socket server that creates a socket and listens for and caches UDP packets
+
+    Every read event drains the socket: datagrams are received in a non-blocking loop until the socket is empty
+    (or batch_size of them are received, so that other greenlets are not starved under a flood).
 
-        # Old-style class super
-        asyncore.dispatcher.__init__(self)
+    Every message goes to the cache of its syslog tag (routes).  Lines pushed out of a full cache (overflows, per tag)
+    and datagrams that are not syslog messages or have a tag without a cache (errors) are counted, not logged.
 
-        # asyncore server init
-        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)  # asyncore socket wrapper
-        self.bind(address)  # bind afore wrapped socket to address
+    A (host, port) address is a UDP socket, a str address is a path of a UNIX datagram socket
+    (nginx "syslog:server=unix:/path").  The socket file is created with "permissions" (octal str or int) and removed
+    on close.  Anyone who can write to the socket can inject log lines, so it is 0660 by default: nginx workers have to
+    share the group of the agent, or the listener has to be configured with wider permissions explicitly.
+    """
+
+    def __init__(self, cache, address, chunk_size=8192, batch_size=None, rcvbuf=None, permissions=None,
+                 tag=DEFAULT_TAG):
+        # Explicitly passed shared cache object for messages with "tag", more can be added to routes
+        self.routes = {}  # tag -> cache
+        if cache is not None:
+            self.routes[tag] = cache
+
+        self.overflows = {}  # tag -> lines pushed out of the full cache
+        self.errors = 0
+
+        # server-wide drops already reported by dropped()
+        self.reported_errors = 0
+        self.reported_kernel_drops = 0
+
+        # Custom constants
+        nginx_config = context.app_config.get('nginx', {})
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size or int(nginx_config.get('syslog_batch', 1000))
+        self.rcvbuf = rcvbuf or int(nginx_config.get('syslog_rcvbuf', 4194304))
+
+        if isinstance(address, basestring):
+            self.path = address
+            self.path_inode = None
+            self.permissions = int(permissions, 8) if isinstance(permissions, basestring) else permissions or 0o660
+            self.remove_stale_socket_file()
+            family = socket.AF_UNIX
+        else:
+            self.path = None
+            family = socket.AF_INET
+
+        self.socket = gsocket.socket(family, socket.SOCK_DGRAM)
+        try:
+            # the kernel caps this by net.core.rmem_max
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        except socket.error:
+            context.log.debug('failed to set receive buffer size of syslog socket', exc_info=True)
+        self.socket.settimeout(0.0)  # recv raises EWOULDBLOCK instead of waiting when the socket is drained
+        self.socket.bind(address)
+        if self.path:
+            os.chmod(self.path, self.permissions)
+            self.path_inode = os.stat(self.path).st_ino
         self.address = self.socket.getsockname()  # use socket api to retrieve address (address we actually bound to)
         SYSLOG_ADDRESSES.add(self.address)
-        context.log.debug('syslog server binding to %s' % str(self.address))
+        context.log.debug(
+            'syslog server binding to %s (receive buffer: %s)' % (
+                str(self.address), self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            )
+        )
+
+    def serve(self, timeout):
+        """
+        Waits up to "timeout" seconds for the socket to become readable and drains it
+
+        recv returns a queued datagram without switching to the hub, so after every batch the server yields
+        explicitly, otherwise a listener loop would starve all other greenlets under a steady flood.
 
-    def handle_read(self):
-        """Called when a read event happens on the socket"""
-        data = bytes.decode(self.recv(self.chunk_size).strip())
+        :param timeout: float seconds
+        :return: int number of datagrams handled
+        """
+        # the first datagram is awaited by the socket itself, so that close() cancels the wait
+        self.socket.settimeout(timeout)
         try:
-            log_record = data.split('amplify: ', 1)[1]  # this implicitly relies on the nginx syslog format specifically
-            self.cache.append(log_record)
-        except Exception:
-            context.log.error('error handling syslog message (address:%s, message:"%s")' % (self.address, data))
-            context.log.debug('additional info:', exc_info=True)
+            data = self.socket.recv(self.chunk_size)
+        except socket.timeout:
+            return 0
+        finally:
+            self.socket.settimeout(0.0)
+
+        self.handle_message(data)
+        count = 1 + self.handle_read(limit=self.batch_size - 1)
+        gevent.sleep(0)
+        return count
+
+    def handle_read(self, limit=None):
+        """
+        Receives all pending datagrams (at most batch_size of them)
+
+        :param limit: int max number of datagrams, batch_size by default
+        :return: int number of datagrams handled
+        """
+        recv, chunk_size = self.socket.recv, self.chunk_size
+        limit = self.batch_size if limit is None else limit
+        count = 0
+        while count < limit:
+            try:
+                data = recv(chunk_size)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            self.handle_message(data)
+            count += 1
+        return count
+
+    def handle_message(self, data):
+        """Caches a log record from a datagram in the cache of its tag"""
+        parsed = parse_rfc3164(data)
+        cache = self.routes.get(parsed[0]) if parsed is not None else None
+        if cache is None:
+            self.errors += 1
+            if self.errors == 1:
+                context.log.warning(
+                    'syslog message with unexpected tag %s (address:%s, expected tags:%s)' % (
+                        parsed[0] if parsed is not None else None, self.address, ','.join(sorted(self.routes))
+                    )
+                )
+                context.log.debug('unexpected syslog message: %r' % data)
+            return
+
+        if len(cache) == cache.maxlen:
+            tag = parsed[0]
+            self.overflows[tag] = self.overflows.get(tag, 0) + 1  # the oldest line is pushed out
+        cache.append(parsed[1])
+
+    def kernel_drops(self):
+        """
+        Reads the number of datagrams the kernel dropped because the socket buffer was full
+
+        :return: int drops since the socket was created or None if unknown
+        """
+        if self.path:
+            return None  # UNIX datagram sockets make the sender wait or fail rather than drop
+
+        try:
+            inode = str(os.fstat(self.socket.fileno()).st_ino)
+        except (OSError, socket.error):
+            return None
+
+        for proc_file in PROC_NET_UDP:
+            try:
+                with open(proc_file) as f:
+                    next(f, None)  # header
+                    for line in f:
+                        fields = line.split()
+                        # sl local_address rem_address st tx:rx tr:when retrnsmt uid timeout inode ref pointer drops
+                        if len(fields) >= 13 and fields[9] == inode:
+                            return int(fields[12])
+            except (IOError, ValueError):
+                continue
+        return None
+
+    def dropped(self):
+        """
+        Server-wide drops since the previous call (of any tail):
+         - decode: datagrams that were not syslog messages or had a tag no tail waits for
+         - kernel: dropped by the kernel because the socket buffer was full
+
+        :return: {} of reason -> int number of datagrams
+        """
+        result = {'decode': self.errors - self.reported_errors}
+        self.reported_errors = self.errors
+
+        kernel_drops = self.kernel_drops()
+        if kernel_drops is not None:
+            result['kernel'] = max(0, kernel_drops - self.reported_kernel_drops)
+            self.reported_kernel_drops = kernel_drops
+
+        return result
+
+    def remove_stale_socket_file(self):
+        """
+        Removes a socket file left by an agent that didn't stop cleanly.  A socket some live process
+        (another agent, a syslog daemon) is bound to is not taken over.
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(self.path)
+        except socket.error as e:
+            if e.args[0] == errno.ECONNREFUSED:
+                self.remove_socket_file()  # nobody is bound to it
+            elif e.args[0] != errno.ENOENT:
+                raise
+        else:
+            raise AmplifyAddresssAlreadyInUse(
+                message='cannot bind syslog socket "%s" because another process is bound to it' % self.path,
+                payload=dict(address=self.path)
+            )
+        finally:
+            probe.close()
+
+    def remove_socket_file(self, inode=None):
+        """
+        Removes the UNIX socket file
+
+        :param inode: int inode of the file to remove, any socket file if None
+        """
+        try:
+            st = os.stat(self.path)
+            if stat.S_ISSOCK(st.st_mode) and (inode is None or st.st_ino == inode):
+                os.remove(self.path)
+        except OSError:
+            pass
 
     def close(self):
         context.log.debug('syslog server closing')
-        asyncore.dispatcher.close(self)
+        self.socket.close()
+        if self.path and self.path_inode:
+            self.remove_socket_file(inode=self.path_inode)  # unless it was replaced by another socket meanwhile
 
 
 class SyslogListener(AbstractManager):
     """This is just a container to manage the SyslogServer listen/handle loop."""
     name = 'syslog_listener'
 
-    def __init__(self, cache, address, **kwargs):
+    def __init__(self, cache, address, permissions=None, **kwargs):
         super(SyslogListener, self).__init__(**kwargs)
-        self.server = SyslogServer(cache, address)
+        self.server = SyslogServer(cache, address, permissions=permissions)
+        self.thread = None
 
     def start(self):
         current_thread().name = self.name
@@ -85,12 +315,14 @@ class SyslogListener(AbstractManager):
 
         self.running = True
 
-        while self.running:
-            self._wait(0.1)
-            # This means that we don't increment every time a UDP message is handled, but rather every listen "period"
-            context.inc_action_id()
-            asyncore.loop(timeout=self.interval, count=10)
-            # count is arbitrary since timeout is unreliable at breaking asyncore.loop
+        try:
+            while self.running:
+                # This means that we don't increment every time a UDP message is handled, but rather every wakeup
+                if self.server.serve(timeout=self.interval):
+                    context.inc_action_id()
+        except GreenletExit:
+            self.running = False
+            raise
 
     def stop(self):
         self.server.close()
@@ -99,12 +331,32 @@ class SyslogListener(AbstractManager):
 
 
 class SyslogTail(Pipeline):
-    """Generalized Pipeline wrapper to provide a developer API for interacting with UDP listener."""
-    def __init__(self, address, maxlen=10000, **kwargs):
-        super(SyslogTail, self).__init__(name='syslog:%s' % str(address))
+    """
+    Generalized Pipeline wrapper to provide a developer API for interacting with UDP or UNIX socket listener.
+
+    Tails with the same address share the listener; every tail gets messages with its own syslog tag.
+
+    The cache holds at most "maxlen" lines between collect cycles.  It starts at syslog_buffer_min lines and is
+    resized between syslog_buffer_min and syslog_buffer_max on every swap: doubled when the previous cycle filled it
+    by more than 3/4 (or overflowed), halved when it was filled by less than 1/4.
+    """
+    def __init__(self, address, maxlen=None, tag=DEFAULT_TAG, **kwargs):
+        # the name is a part of log metric names and filters, so only non-default tags are added to it
+        name = 'syslog:%s' % str(address) if tag == DEFAULT_TAG else 'syslog:%s,tag=%s' % (str(address), tag)
+        super(SyslogTail, self).__init__(name=name)
         self.kwargs = kwargs  # only have to record this due to new listener fail-over logic
-        self.maxlen = maxlen
+        self.tag = tag
+
+        nginx_config = context.app_config.get('nginx', {})
+        self.min_maxlen = maxlen or int(nginx_config.get('syslog_buffer_min', 10000))
+        self.max_maxlen = max(self.min_maxlen, int(nginx_config.get('syslog_buffer_max', 100000)))
+        self.maxlen = self.min_maxlen
         self.cache = deque(maxlen=self.maxlen)
+
+        # overflows of the tag already reported by dropped() and at the moment of the last swap
+        self.reported_overflows = 0
+        self.swapped_overflows = 0
+
         self.address = address  # This stores the address that we were passed
         self.listener = None
         self.listener_setup_attempts = 0
@@ -150,34 +402,113 @@ class SyslogTail(Pipeline):
                     )
                     context.log.debug('additional info:', exc_info=True)
 
-        current_cache = copy.deepcopy(self.cache)
+        current_cache = self.swap_cache()
         context.log.debug('syslog tail returned %s lines captured from %s' % (len(current_cache), self.name))
-        self.cache.clear()
         return iter(current_cache)
 
+    def swap_cache(self):
+        """
+        Detaches the filled cache and gives the listener an empty one
+
+        Both run in the same hub, so nothing is appended between the two assignments and no line is lost.
+        A new deque is created every time rather than reusing the detached one, because a collector that ran
+        out of its budget keeps iterating the detached cache during the next cycle.
+
+        :return: deque of lines
+        """
+        current_cache = self.cache
+        if self.listener:
+            overflows = self.listener.server.overflows.get(self.tag, 0)
+            self.resize(len(current_cache) + overflows - self.swapped_overflows)
+            self.swapped_overflows = overflows
+            self.cache = self.listener.server.routes[self.tag] = deque(maxlen=self.maxlen)
+        else:
+            self.cache = deque(maxlen=self.maxlen)
+        return current_cache
+
+    def resize(self, arrived):
+        """
+        Picks the size of the next cache
+
+        :param arrived: int number of lines that arrived since the previous swap
+        """
+        maxlen = self.maxlen
+        if arrived * 4 > maxlen * 3:
+            maxlen = min(self.max_maxlen, max(maxlen * 2, arrived * 2))
+        elif arrived * 4 < maxlen:
+            maxlen = max(self.min_maxlen, maxlen // 2)
+
+        if maxlen != self.maxlen:
+            context.log.debug('syslog tail %s buffer resized from %s to %s lines (arrived: %s)' % (
+                self.name, self.maxlen, maxlen, arrived
+            ))
+            self.maxlen = maxlen
+
+    def dropped(self):
+        """
+        Lines lost since the previous call:
+         - overflow: pushed out of the full cache before the collector read them
+         - kernel, decode: server-wide drops (see SyslogServer.dropped), reported by the first tail that asks
+
+        :return: {} of reason -> int number of lines
+        """
+        if not self.listener:
+            return {}
+
+        server = self.listener.server
+        overflows = server.overflows.get(self.tag, 0)
+        result = server.dropped()
+        result['overflow'] = overflows - self.reported_overflows
+        self.reported_overflows = overflows
+        return result
+
     def _setup_listener(self, **kwargs):
-        if self.address in SYSLOG_ADDRESSES:
+        listener = SYSLOG_LISTENERS.get(self.address)
+
+        if (listener is None and self.address in SYSLOG_ADDRESSES) or \
+                (listener is not None and self.tag in listener.server.routes):
             self.listener_setup_attempts += 1
             raise AmplifyAddresssAlreadyInUse(
                 message='cannot initialize "%s" because address is already in use' % self.name,
                 payload=dict(
                     address=self.address,
+                    tag=self.tag,
                     used=list(SYSLOG_ADDRESSES)
                 )
             )
 
-        SYSLOG_ADDRESSES.add(self.address)
-        self.listener = SyslogListener(cache=self.cache, address=self.address, **kwargs)
-        self.thread = spawn(self.listener.start)
+        if listener is None:
+            SYSLOG_ADDRESSES.add(self.address)
+            try:
+                listener = SyslogListener(cache=None, address=self.address, **kwargs)
+            except AmplifyAddresssAlreadyInUse:
+                SYSLOG_ADDRESSES.discard(self.address)
+                self.listener_setup_attempts += 1
+                raise
+            listener.thread = spawn(listener.start)
+            SYSLOG_LISTENERS[self.address] = listener
+
+        listener.server.routes[self.tag] = self.cache
+        self.reported_overflows = self.swapped_overflows = listener.server.overflows.get(self.tag, 0)
+        self.listener = listener
+        self.thread = listener.thread
 
     def stop(self):
         if self.running:
-            # Remove from used addresses
-            for address in set((self.address, self.listener.server.address)):
-                SYSLOG_ADDRESSES.remove(address)
+            if self.listener:
+                server = self.listener.server
+                server.routes.pop(self.tag, None)
+
+                # the last tail of the listener stops it
+                if not server.routes:
+                    SYSLOG_LISTENERS.pop(self.address, None)
+
+                    # Remove from used addresses
+                    for address in set((self.address, server.address)):
+                        SYSLOG_ADDRESSES.discard(address)
 
-            self.listener.stop()  # Close the UDP server
-            self.thread.kill()  # Kill the greenlet
+                    self.thread.kill()  # Kill the greenlet (before closing the socket it waits on)
+                    self.listener.stop()  # Close the UDP server
 
             # Unassign variables to reduce reference count for GC
             self.listener = None
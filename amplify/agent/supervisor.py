@@ -317,6 +317,10 @@ class Supervisor(object):
             object_manager = self.object_managers[object_manager_name]
             object_manager.stop()
 
+        # stop log parsing workers
+        from amplify.agent.collectors.nginx.parsepool import stop_parse_pool
+        stop_parse_pool()
+
         # log agent stopped event
         context.log.info(
             'agent stopped, version=%s pid=%s uuid=%s' %
@@ -64,6 +64,13 @@ class BaseTestCase(TestCase):
 
         import amplify.agent.pipelines.file
         amplify.agent.pipelines.file.OFFSET_CACHE = {}
+        amplify.agent.pipelines.file.OFFSET_STORE = None
+
+        import amplify.agent.pipelines.shared
+        amplify.agent.pipelines.shared.SHARED_FILES = {}
+
+        import amplify.agent.collectors.nginx.parsepool
+        amplify.agent.collectors.nginx.parsepool.PARSE_POOL = None
 
     def teardown_method(self, method):
         pass
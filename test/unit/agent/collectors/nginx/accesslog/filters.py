@@ -281,6 +281,36 @@ class LogsFiltersTestCase(NginxCollectorTestCase):
         assert_that(timer["G|nginx.upstream.response.time.median"][0][1], equal_to(4.000))
         assert_that(timer["C|nginx.upstream.response.time.count"][0][1], equal_to(4))
 
+    def test_parent_filters(self):
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.request.time.median', data=[['$status', '~', '2']]),
+            Filter(filter_rule_id=2, metric='nginx.http.request.time', data=[['$status', '~', '3']]),
+            Filter(filter_rule_id=3, metric='nginx.http.status.2xx', data=[['$status', '~', '2']]),
+        ]
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
+
+        parent_filters = collector.parent_filters['nginx.http.request.time']
+        assert_that(parent_filters.values(), contains_inanyorder(
+            'nginx.http.request.time||1', 'nginx.http.request.time||2'
+        ))
+        assert_that(collector.parent_filters['nginx.upstream.response.time'], equal_to({}))
+
+        # nothing is copied per line
+        original_deepcopy = Filter.__deepcopy__
+
+        def fail(*args, **kwargs):
+            raise AssertionError('filter should not be copied')
+
+        Filter.__deepcopy__ = fail
+        try:
+            collector.count_parent_filters(self.fake_object.filters, 'nginx.http.request.time', 0.5)
+        finally:
+            Filter.__deepcopy__ = original_deepcopy
+
+        timers = self.fake_object.statsd.current['timer']
+        assert_that(timers['nginx.http.request.time||1'], equal_to([0.5]))
+        assert_that(timers['nginx.http.request.time||2'], equal_to([0.5]))
+
     def test_separate_4xx_5xx_with_filters(self):
         self.fake_object.filters = [
             Filter(
@@ -314,3 +344,22 @@ class LogsFiltersTestCase(NginxCollectorTestCase):
 
         # filter values
         assert_that(counter['C|nginx.http.status.502||1'][0][1], equal_to(1))
+
+    def test_filter_keys_are_parsed(self):
+        self.fake_object.filters = [
+            Filter(
+                filter_rule_id=2,
+                metric='nginx.http.status.2xx',
+                data=[
+                    ['$http_user_agent', '~', '.*Safari']
+                ]
+            )
+        ]
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=self.lines)
+        assert_that(collector.parser.needed_keys, has_item('http_user_agent'))
+        assert_that(collector.parser.needed_keys, not_(has_item('http_referer')))
+
+        collector.collect()
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.http.status.2xx||2'][0][1], equal_to(2))
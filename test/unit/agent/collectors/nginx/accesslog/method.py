@@ -23,6 +23,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_method(NginxAccessLogParser().parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -38,6 +39,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_method(NginxAccessLogParser().parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -53,6 +55,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_status(NginxAccessLogParser().parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -97,6 +100,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -129,6 +133,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -154,6 +159,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -184,6 +190,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -217,6 +224,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -261,6 +269,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.push_counters()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -287,3 +296,32 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         assert_that(histogram, has_item('nginx.upstream.response.time'))
         assert_that(histogram['nginx.upstream.response.time'], equal_to([2.001 + 0.345]))
 
+
+    def test_counters_pushed_once(self):
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' + \
+               '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
+        for _ in xrange(3):
+            collector.http_method(NginxAccessLogParser().parse(line))
+
+        # counted locally
+        assert_that(self.fake_object.statsd.current['counter'], not_(has_item('nginx.http.method.get')))
+        assert_that(collector.local_counters, has_entry('nginx.http.method.get', 3))
+
+        collector.push_counters()
+        assert_that(collector.local_counters, has_length(0))
+        counters = self.fake_object.statsd.current['counter']
+        assert_that(counters['nginx.http.method.get'][0][1], equal_to(3))
+
+    def test_unusual_values(self):
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "Get /basic_status HTTP/1.2" 99 110 "-" ' + \
+               '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[line])
+        collector.collect()
+
+        counters = self.fake_object.statsd.current['counter']
+        assert_that(counters['nginx.http.method.get'][0][1], equal_to(1))
+        assert_that(counters['nginx.http.v1_2'][0][1], equal_to(1))
+        assert_that(counters['nginx.http.status.9xx'][0][1], equal_to(1))
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
+import os
+
 from hamcrest import *
 
 from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.common.context import context
+from amplify.agent.pipelines.abstract import Pipeline
+from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.shared import open_tail
 from test.base import NginxCollectorTestCase
 
 __author__ = "Mike Belov"
@@ -834,3 +840,199 @@ class LogsOverallTestCase(NginxCollectorTestCase):
             elif counter_key is not None:
                 if counter_key not in collector.parser.request_variables:
                     assert_that(counter, not_(has_key('C|%s' % counter_name)))
+
+    def test_needed_keys(self):
+        log_format = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ' + \
+                     '"$http_referer" "$http_user_agent" $request_id $ssl_cipher'
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=[])
+
+        # no upstream variables in the format
+        assert_that(collector.methods, not_(has_item(collector.upstreams)))
+
+        assert_that(collector.parser.needed_keys, equal_to(set([
+            'request', 'request_method', 'status', 'server_protocol', 'request_length',
+            'body_bytes_sent', 'bytes_sent', 'gzip_ratio', 'request_time'
+        ])))
+        for key in ('remote_addr', 'http_user_agent', 'request_id', 'ssl_cipher'):
+            assert_that(collector.parser.parse_source, not_(contains_string(key)))
+
+    def test_needed_keys_upstreams(self):
+        log_format = '$remote_addr "$request" $status "$upstream_addr" $upstream_response_time $http_user_agent'
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=[])
+
+        assert_that(collector.methods, has_item(collector.upstreams))
+        assert_that(collector.parser.needed_keys, has_items('upstream_addr', 'upstream_response_time'))
+        assert_that(collector.parser.needed_keys, not_(has_item('http_user_agent')))
+
+    def test_budget_lines(self):
+        lines = [
+            '127.0.0.1 - - [18/Jun/2015:17:22:33 +0000] "GET /%s HTTP/1.1" 200 2 "-" "curl"' % i for i in xrange(5)
+        ]
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=lines)
+        collector.budget_lines = 2
+
+        original_chunk_lines = Pipeline.chunk_lines
+        Pipeline.chunk_lines = 2
+        try:
+            # 2 + 2 + 1 lines
+            for backlog in (True, True, False):
+                collector.collect()
+                assert_that(collector.backlog is not None, equal_to(backlog))
+        finally:
+            Pipeline.chunk_lines = original_chunk_lines
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.http.method.get'][0][1], equal_to(5))
+
+    def test_backlog_metrics(self):
+        test_log = 'log/budget.log'
+        with open(test_log, 'w') as f:
+            f.write('start\n')
+
+        try:
+            tail = FileTail(filename=test_log)
+            tail.chunk_size = 100
+            collector = NginxAccessLogsCollector(object=self.fake_object, tail=tail)
+            collector.budget_lines = 1
+
+            with open(test_log, 'a') as f:
+                for i in xrange(5):
+                    f.write('127.0.0.1 - - [18/Jun/2015:17:22:33 +0000] "GET /%s HTTP/1.1" 200 2 "-" "curl"\n' % i)
+
+            collector.collect()
+            assert_that(collector.backlog, not_none())
+            gauge = self.fake_object.statsd.flush()['metrics']['gauge']
+            assert_that(gauge['G|controller.agent.log.backlog|%s' % test_log][0][1], greater_than(0))
+            assert_that(gauge, has_key('G|controller.agent.log.lag|%s' % test_log))
+
+            while collector.backlog is not None:
+                collector.collect()
+            self.fake_object.statsd.flush()
+
+            collector.collect()
+            gauge = self.fake_object.statsd.flush()['metrics']['gauge']
+            assert_that(gauge['G|controller.agent.log.backlog|%s' % test_log][0][1], equal_to(0))
+            assert_that(gauge['G|controller.agent.log.lag|%s' % test_log][0][1], equal_to(0))
+        finally:
+            os.remove(test_log)
+
+    def test_drop_metrics(self):
+        class LossyTail(Pipeline):
+            def __iter__(self):
+                return iter([])
+
+            def dropped(self):
+                return {'overflow': 5, 'kernel': 2}
+
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=LossyTail(name='syslog:lossy'))
+        collector.collect()
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|controller.agent.log.dropped.overflow|lossy'][0][1], equal_to(10))
+        assert_that(counter['C|controller.agent.log.dropped.kernel|lossy'][0][1], equal_to(4))
+
+    def test_shared_tail_parsed_once(self):
+        test_log = 'log/shared.log'
+        with open(test_log, 'w') as f:
+            f.write('start\n')
+
+        try:
+            collectors = [
+                NginxAccessLogsCollector(object=self.fake_object, tail=open_tail(test_log)) for _ in xrange(2)
+            ]
+
+            parsed_lines = []
+            for collector in collectors:
+                def parse(line, original=collector.parser.parse):
+                    parsed_lines.append(line)
+                    return original(line)
+                collector.parser.parse = parse
+
+            with open(test_log, 'a') as f:
+                for i in xrange(3):
+                    f.write('127.0.0.1 - - [18/Jun/2015:17:22:33 +0000] "GET /%s HTTP/1.1" 200 2 "-" "curl"\n' % i)
+
+            for collector in collectors:
+                collector.collect()
+
+            assert_that(parsed_lines, has_length(3))
+            counter = self.fake_object.statsd.flush()['metrics']['counter']
+            assert_that(counter['C|nginx.http.method.get'][0][1], equal_to(6))
+        finally:
+            for collector in collectors:
+                collector.tail.stop()
+            os.remove(test_log)
+
+    def test_top(self):
+        log_format = '$remote_addr "$request" $status "$http_user_agent" "$upstream_addr"'
+        lines = [
+            '1.1.1.1 "GET /a HTTP/1.1" 200 "curl" "10.0.0.1:80"',
+            '1.1.1.1 "GET /a HTTP/1.1" 502 "curl" "10.0.0.1:80, 10.0.0.2:80"',
+            '2.2.2.2 "GET /b HTTP/1.1" 502 "Chrome" "10.0.0.2:80"',
+            '2.2.2.2 "GET /a HTTP/1.1" 200 "Chrome" "-"',
+        ]
+
+        # disabled by default
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=lines)
+        assert_that(collector.methods, not_(has_item(collector.top)))
+
+        context.app_config['nginx']['log_top_k'] = '1'
+        try:
+            collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=lines)
+        finally:
+            context.app_config['nginx'].pop('log_top_k')
+        assert_that(collector.parser.needed_keys, has_items('remote_addr', 'http_user_agent', 'upstream_addr'))
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        top = dict((key, value[0][1]) for key, value in counter.iteritems() if '.top.' in key)
+        assert_that(top, equal_to({
+            'C|nginx.http.top.request_uri.2xx|/a': 2,
+            'C|nginx.http.top.request_uri.5xx|/a': 1,
+            'C|nginx.http.top.remote_addr.2xx|1.1.1.1': 1,
+            'C|nginx.http.top.remote_addr.5xx|1.1.1.1': 1,
+            'C|nginx.http.top.http_user_agent.2xx|curl': 1,
+            'C|nginx.http.top.http_user_agent.5xx|curl': 1,
+            'C|nginx.http.top.upstream_addr.2xx|10.0.0.1:80': 1,
+            'C|nginx.http.top.upstream_addr.5xx|10.0.0.2:80': 2,
+        }))
+
+    def test_upstream_peers(self):
+        log_format = '"$request" $status "$upstream_addr" "$upstream_status" ' + \
+                     'ut="$upstream_response_time" uct="$upstream_connect_time"'
+        lines = [
+            '"GET /a HTTP/1.1" 200 "10.0.0.1:80" "200" ut="0.100" uct="0.010"',
+            '"GET /a HTTP/1.1" 200 "10.0.0.1:80, 10.0.0.2:80" "502, 200" ut="1.000, 0.200" uct="0.020, 0.030"',
+            '"GET /a HTTP/1.1" 502 "10.0.0.3:80, 10.0.0.4:80" "502, 504" ut="0.300, 0.400" uct="0.040"',
+        ]
+
+        context.app_config['nginx']['log_upstream_peers'] = '2'
+        try:
+            collector = NginxAccessLogsCollector(object=self.fake_object, log_format=log_format, tail=lines)
+        finally:
+            context.app_config['nginx'].pop('log_upstream_peers')
+        collector.collect()
+
+        metrics = self.fake_object.statsd.flush()['metrics']
+        counter, timer = metrics['counter'], metrics['timer']
+
+        assert_that(counter['C|nginx.upstream.peer.status.2xx|10.0.0.1:80'][0][1], equal_to(1))
+        assert_that(counter['C|nginx.upstream.peer.status.5xx|10.0.0.1:80'][0][1], equal_to(1))
+        assert_that(counter['C|nginx.upstream.peer.status.2xx|10.0.0.2:80'][0][1], equal_to(1))
+        assert_that(timer['C|nginx.upstream.peer.response.time.count|10.0.0.1:80'][0][1], equal_to(2))
+        assert_that(timer['G|nginx.upstream.peer.response.time.max|10.0.0.1:80'][0][1], equal_to(1.0))
+        assert_that(timer['G|nginx.upstream.peer.connect.time|10.0.0.2:80'][0][1], equal_to(0.03))
+
+        # peers above the limit share one bucket
+        assert_that(counter['C|nginx.upstream.peer.status.5xx|overflow'][0][1], equal_to(2))
+        assert_that(timer['C|nginx.upstream.peer.response.time.count|overflow'][0][1], equal_to(2))
+        for key in counter.keys() + timer.keys():
+            assert_that(key, not_(contains_string('10.0.0.3')))
+
+        # connect times don't match the peers
+        assert_that(timer['C|nginx.upstream.peer.connect.time.count|10.0.0.1:80'][0][1], equal_to(2))
+        assert_that(timer, not_(has_key('C|nginx.upstream.peer.connect.time.count|overflow')))
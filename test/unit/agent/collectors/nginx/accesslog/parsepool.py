@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import copy
+import time
+
+from hamcrest import *
+
+import amplify.agent.collectors.nginx.parsepool
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.collectors.nginx.parsepool import ParseWorker, get_parse_pool, stop_parse_pool
+from amplify.agent.common.context import context
+from amplify.agent.data.sketch import TimerSketch
+from amplify.agent.data.statsd import StatsdClient
+from amplify.agent.objects.nginx.filters import Filter
+from test.base import NginxCollectorTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class ParsePoolTestCase(NginxCollectorTestCase):
+
+    log_format = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ' + \
+                 '"$http_referer" "$http_user_agent" rt=$request_time ut="$upstream_response_time" ' + \
+                 'cs=$upstream_cache_status us="$upstream_status"'
+
+    lines = [
+        '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "-" "Chrome" '
+        'rt=0.010 ut="2.001, 0.345" cs=MISS us="502, 200"',
+
+        '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "POST /bar/ HTTP/1.0" 404 45 "-" "Safari" '
+        'rt=0.021 ut="-" cs=- us="-"',
+
+        '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/2.0" 503 100 "-" "Chrome" '
+        'rt=1.200 ut="1.100" cs=HIT us="503"',
+
+        '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "\\x16\\x03" 400 0 "-" "-" rt=0.000 ut="-" cs=- us="-"',
+    ]
+
+    def setup_method(self, method):
+        super(ParsePoolTestCase, self).setup_method(method)
+        self.original_fake_object = copy.copy(self.fake_object)
+        self.fake_object.filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.status.2xx', data=[['$request_uri', '~', '/foo']]),
+            Filter(filter_rule_id=2, metric='nginx.http.request.time', data=[['$http_user_agent', '~', 'Chrome']]),
+        ]
+
+    def teardown_method(self, method):
+        stop_parse_pool()
+        context.app_config['nginx'].pop('log_workers', None)
+        context.app_config['nginx'].pop('log_worker_timeout', None)
+        self.fake_object = self.original_fake_object
+        super(ParsePoolTestCase, self).teardown_method(method)
+
+    def collect(self, lines=None):
+        self.fake_object.statsd = StatsdClient(object=self.fake_object)
+        tail = lines if lines is not None else self.lines * 5
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=self.log_format, tail=tail)
+        collector.collect()
+
+        # drop timestamps
+        current = self.fake_object.statsd.current
+        counters = dict((name, sum(value for _, value in slots)) for name, slots in current['counter'].iteritems())
+        return collector, counters, current['timer'], current['average']
+
+    def test_disabled_by_default(self):
+        assert_that(get_parse_pool(), equal_to(None))
+
+        collector, _, _, _ = self.collect()
+        assert_that(collector.pool, equal_to(None))
+
+    def test_same_metrics(self):
+        _, counters, timers, averages = self.collect()
+
+        context.app_config['nginx']['log_workers'] = '2'
+        stop_parse_pool()  # forget the disabled pool
+        collector, pool_counters, pool_timers, pool_averages = self.collect()
+        assert_that(collector.pool, not_none())
+        assert_that(collector.pool.workers, has_item(not_none()))
+
+        assert_that(counters, has_entry('nginx.http.status.2xx||1', 5))
+        assert_that(timers, has_key('nginx.http.request.time||2'))
+
+        # exact timers stay exact
+        assert_that(pool_counters, equal_to(counters))
+        assert_that(pool_timers, equal_to(timers))
+        assert_that(pool_averages, equal_to(averages))
+
+    def test_sketch_timers(self):
+        context.app_config['agent']['timers'] = 'sketch'
+        try:
+            context.app_config['nginx']['log_workers'] = '1'
+            stop_parse_pool()
+            _, _, pool_timers, _ = self.collect()
+        finally:
+            context.app_config['agent'].pop('timers', None)
+
+        # workers send compact sketches rather than all samples
+        assert_that(pool_timers, has_key('nginx.http.request.time||2'))
+        for values in pool_timers.itervalues():
+            assert_that(values, instance_of(TimerSketch))
+
+    def test_fallback(self):
+        _, counters, timers, _ = self.collect()
+
+        context.app_config['nginx']['log_workers'] = '1'
+        stop_parse_pool()
+
+        # worker process dies
+        def broken_request(worker, message):
+            worker.process.terminate()
+            raise EOFError
+
+        original_request = ParseWorker.request
+        ParseWorker.request = broken_request
+        try:
+            collector, pool_counters, pool_timers, _ = self.collect()
+        finally:
+            ParseWorker.request = original_request
+
+        assert_that(collector.pool.workers, equal_to([None]))
+        assert_that(pool_counters, equal_to(counters))
+        assert_that(pool_timers, equal_to(timers))
+
+    def test_timeout(self):
+        _, counters, timers, _ = self.collect()
+
+        context.app_config['nginx']['log_workers'] = '1'
+        context.app_config['nginx']['log_worker_timeout'] = '0.2'
+        stop_parse_pool()
+
+        # worker process hangs
+        def hanging_loop(conn):
+            time.sleep(60)
+
+        original_loop = amplify.agent.collectors.nginx.parsepool.worker_loop
+        amplify.agent.collectors.nginx.parsepool.worker_loop = hanging_loop
+        try:
+            collector, pool_counters, pool_timers, _ = self.collect()
+        finally:
+            amplify.agent.collectors.nginx.parsepool.worker_loop = original_loop
+
+        assert_that(collector.pool.workers, equal_to([None]))
+        assert_that(pool_counters, equal_to(counters))
+        assert_that(pool_timers, equal_to(timers))
+
+    def test_merge_max_series(self):
+        self.fake_object.statsd = StatsdClient(object=self.fake_object)
+        self.fake_object.statsd.max_series = 1
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=self.log_format, tail=[])
+
+        collector.merge({'timer': {'nginx.http.request.time||1': TimerSketch(values=[0.1])}})
+        collector.merge({'timer': {'nginx.http.request.time||2': TimerSketch(values=[0.2])}})
+        collector.merge({'timer': {'nginx.http.request.time||1': TimerSketch(values=[0.3])}})
+
+        # the series cap applies to merged series too
+        timers = self.fake_object.statsd.current['timer']
+        assert_that(timers.keys(), equal_to(['nginx.http.request.time||1']))
+        assert_that(timers['nginx.http.request.time||1'], has_length(2))
+
+    def test_worker_series(self):
+        context.app_config['agent']['max_series'] = '1'
+        try:
+            context.app_config['nginx']['log_workers'] = '1'
+            stop_parse_pool()
+
+            # the first partial has a series of filter 1, the second one has a series of filter 2
+            _, counters, _, _ = self.collect(lines=[
+                '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 10 "-" "Safari" '
+                'rt=0.010 ut="-" cs=- us="-"',
+            ])
+            _, _, timers, _ = self.collect(lines=[
+                '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /bar/ HTTP/1.1" 200 10 "-" "Chrome" '
+                'rt=0.010 ut="-" cs=- us="-"',
+            ])
+        finally:
+            context.app_config['agent'].pop('max_series', None)
+
+        # the worker doesn't keep series of previous partials
+        assert_that(counters, has_key('nginx.http.status.2xx||1'))
+        assert_that(timers, has_key('nginx.http.request.time||2'))
+
+    def test_worker_parses_in_process(self):
+        context.app_config['nginx']['log_workers'] = '1'
+        stop_parse_pool()
+        assert_that(get_parse_pool(), not_none())
+
+        # the worker forgets the pool it inherited
+        def probe_loop(conn):
+            amplify.agent.collectors.nginx.parsepool.setup_worker(conn)
+            conn.recv()
+            conn.send((True, get_parse_pool()))
+
+        original_loop = amplify.agent.collectors.nginx.parsepool.worker_loop
+        amplify.agent.collectors.nginx.parsepool.worker_loop = probe_loop
+        try:
+            worker = ParseWorker(timeout=5.0)
+            assert_that(worker.request('probe'), equal_to((True, None)))
+            worker.stop()
+        finally:
+            amplify.agent.collectors.nginx.parsepool.worker_loop = original_loop
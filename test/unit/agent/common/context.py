@@ -37,6 +37,21 @@ class ContextTestCase(BaseTestCase):
         assert_that(context.uuid, equal_to(DEFAULT_UUID))
 
 
+    def test_listeners(self):
+        context.app_config['listeners'] = {'keys': 'udp,unix,bad'}
+        context.app_config['listener_udp'] = {'address': '127.0.0.1:5140'}
+        context.app_config['listener_unix'] = {'address': 'unix:/var/run/amplify.sock', 'permissions': '0660'}
+        context.app_config['listener_bad'] = {'address': 'localhost:port'}
+        try:
+            context._setup_app_listeners()
+            assert_that(context.listeners, has_length(2))
+            assert_that(context.listeners, has_key('127.0.0.1:5140'))
+            assert_that(context.listeners['unix:/var/run/amplify.sock'], has_entry('permissions', '0660'))
+        finally:
+            context.app_config['listeners'] = {'keys': 'syslog-default'}
+            context._setup_app_listeners()
+
+
 class ContextContainerTestCase(BaseTestCase):
 
     def setup_method(self, method):
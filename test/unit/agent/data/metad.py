@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.data.metad import MetadClient
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class MetadClientTestCase(BaseTestCase):
+
+    def test_flush_copies_meta(self):
+        client = MetadClient()
+        meta = {'type': 'nginx', 'ssl': {'built': ['OpenSSL', '1.0.2g']}, 'running': True}
+        client.meta(meta)
+
+        delivery = client.flush()
+        assert_that(delivery, has_entries(type='nginx', running=True, agent=not_none()))
+        assert_that(meta, not_(has_key('agent')))
+
+        # the collector updates its dict later, the queued payload doesn't change
+        meta['ssl']['built'] = ['OpenSSL', '1.1.0']
+        meta['running'] = False
+        assert_that(delivery['running'], equal_to(True))
+        assert_that(delivery['ssl'], equal_to({'built': ['OpenSSL', '1.0.2g']}))
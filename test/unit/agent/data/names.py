@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.data.names import MetricNames, METRIC_NAMES
+from amplify.agent.data.statsd import StatsdClient
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class MetricNamesTestCase(BaseTestCase):
+
+    def test_handles(self):
+        names = MetricNames()
+        handle = names.handle('nginx.http.request.time||42')
+        assert_that(handle, instance_of(int))
+        assert_that(names.handle('nginx.http.request.time||42'), equal_to(handle))
+        assert_that(names.dimension('nginx.http.request.time', 42, '||'), equal_to(handle))
+        assert_that(names.name(handle), equal_to('nginx.http.request.time||42'))
+        assert_that(names, has_length(1))
+
+        metric = names.get(handle)
+        assert_that(names.get('nginx.http.request.time||42'), same_instance(metric))
+        assert_that(metric.counter, equal_to('C|nginx.http.request.time||42'))
+        assert_that(metric.gauge, equal_to('G|nginx.http.request.time||42'))
+        assert_that(metric.count, equal_to('C|nginx.http.request.time.count||42'))
+        assert_that(metric.max, equal_to('G|nginx.http.request.time.max||42'))
+        assert_that(metric.median, equal_to('G|nginx.http.request.time.median||42'))
+        assert_that(metric.pctl95, equal_to('G|nginx.http.request.time.pctl95||42'))
+
+    def test_max_size(self):
+        names = MetricNames(max_size=1)
+        assert_that(names.handle('system.net.bytes_sent|eth0'), equal_to(0))
+
+        # names above the limit are not registered, but still work
+        assert_that(names.dimension('system.net.bytes_sent', 'eth1'), equal_to('system.net.bytes_sent|eth1'))
+        assert_that(names.get('system.net.bytes_sent|eth1').count, equal_to('C|system.net.bytes_sent.count|eth1'))
+        assert_that(names, has_length(1))
+
+    def test_get_does_not_register(self):
+        names = MetricNames()
+        handle = names.handle('nginx.http.request.time')
+
+        assert_that(names.get('nginx.http.request.time'), same_instance(names.get(handle)))
+        assert_that(names.get('nginx.upstream.peer.time|10.0.0.1:80').max, equal_to(
+            'G|nginx.upstream.peer.time.max|10.0.0.1:80'
+        ))
+        assert_that(names, has_length(1))
+
+    def test_flush_does_not_register(self):
+        class FakeObject(object):
+            definition = {}
+
+        client = StatsdClient(object=FakeObject())
+        size = len(METRIC_NAMES)
+        client.incr('nginx.http.request.uri|/not/registered/%s' % id(client))
+        client.timer('nginx.upstream.peer.time|10.0.0.1:%s' % id(client), 0.5)
+        metrics = client.flush()['metrics']
+
+        assert_that(metrics['counter'], has_key('C|nginx.http.request.uri|/not/registered/%s' % id(client)))
+        assert_that(metrics['timer'], has_key('G|nginx.upstream.peer.time.max|10.0.0.1:%s' % id(client)))
+        assert_that(METRIC_NAMES, has_length(size))
+
+    def test_statsd_handles(self):
+        class FakeObject(object):
+            definition = {}
+
+        by_name, by_handle = StatsdClient(object=FakeObject()), StatsdClient(object=FakeObject())
+        for name in ('nginx.http.method.get||1', 'system.net.bytes_sent|eth0'):
+            handle = METRIC_NAMES.handle(name)
+            for client, key in ((by_name, name), (by_handle, handle)):
+                client.incr(key, 2, stamp=100)
+                client.gauge(key, 1.0, stamp=100)
+                client.timer(key, 0.5)
+                client.average(key, 3)
+
+        assert_that(by_handle.current['counter'], has_key('nginx.http.method.get||1'))
+        def values(client):
+            metrics = client.flush()['metrics']
+            return dict((key, value[0][1]) for section in metrics.itervalues() for key, value in section.iteritems())
+
+        assert_that(values(by_handle), equal_to(values(by_name)))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import random
+
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.data.sketch import HeavyHitters, TimerSketch
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class TimerSketchTestCase(BaseTestCase):
+
+    def test_relative_error(self):
+        values = [random.lognormvariate(-3, 2) for _ in xrange(10000)] + [0.0] * 100
+        sketch = TimerSketch(accuracy=0.01, values=values)
+        values.sort()
+
+        assert_that(len(sketch), equal_to(len(values)))
+        assert_that(sketch.max, equal_to(values[-1]))
+        assert_that(sketch.sum, close_to(sum(values), 1e-6))
+
+        ranks = range(0, len(values), 97)
+        for rank, estimate in zip(ranks, sketch.values_at_ranks(ranks)):
+            assert_that(estimate, close_to(values[rank], values[rank] * 0.01 + 1e-12))
+
+    def test_summary(self):
+        values = [0.1, 0.2, 0.3, 0.4, 10.0]
+        mean, count, max_value, median, pctl95 = TimerSketch(values=values).summary()
+
+        assert_that(mean, close_to(2.2, 1e-9))
+        assert_that(count, equal_to(5))
+        assert_that(max_value, equal_to(10.0))
+        assert_that(median, close_to(0.3, 0.003))
+        assert_that(pctl95, close_to(0.1, 0.001))  # same as values[-int(round(5 * .05))] of a sorted list
+
+        values = [float(i) for i in xrange(1, 101)]
+        _, _, _, median, pctl95 = TimerSketch(values=values).summary()
+        assert_that(median, close_to(50.5, 0.51))
+        assert_that(pctl95, close_to(96, 0.96))
+
+    def test_merge(self):
+        first = TimerSketch(values=[1.0, 2.0, 3.0])
+        second = TimerSketch(values=[4.0, 0.0])
+        first.extend(second)
+
+        assert_that(len(first), equal_to(5))
+        assert_that(first.min, equal_to(0.0))
+        assert_that(first.max, equal_to(4.0))
+        assert_that(first.values_at_ranks([0, 2, 4]), contains(0.0, close_to(2.0, 0.02), close_to(4.0, 0.04)))
+
+    def test_bounded_memory(self):
+        sketch = TimerSketch(accuracy=0.01)
+        sketch.max_buckets = 100
+        for i in xrange(1, 100000):
+            sketch.append(i / 1000.0)
+
+        assert_that(len(sketch.buckets), equal_to(100))
+        assert_that(len(sketch), equal_to(99999))
+        assert_that(sketch.values_at_ranks([99998]), contains(close_to(99.999, 1)))
+
+
+class HeavyHittersTestCase(BaseTestCase):
+
+    def test_top(self):
+        random.seed(1)
+        heavy = dict(('/heavy/%s' % i, 500 - 50 * i) for i in xrange(5))
+        keys = [key for key, count in heavy.iteritems() for _ in xrange(count)]
+        keys += ['/noise/%s' % random.randint(0, 10000) for _ in xrange(20000)]
+        random.shuffle(keys)
+
+        top = HeavyHitters(k=5, width=512, depth=4)
+        for key in keys:
+            top.add(key)
+
+        assert_that(len(top), equal_to(len(keys)))
+        assert_that([key for key, _ in top.top()], equal_to(sorted(heavy, key=heavy.get, reverse=True)))
+        for key, count in top.top():
+            # count-min never underestimates
+            assert_that(count, greater_than_or_equal_to(heavy[key]))
+            assert_that(count, less_than(heavy[key] + 2 * len(keys) / 512))
+
+    def test_merge(self):
+        first = HeavyHitters(k=2, width=64, depth=2)
+        second = HeavyHitters(k=2, width=64, depth=2)
+        for key, count in (('a', 10), ('b', 5), ('c', 1)):
+            first.add(key, count)
+        for key, count in (('c', 20), ('b', 1)):
+            second.add(key, count)
+
+        first.merge(second)
+        assert_that(len(first), equal_to(37))
+        assert_that([key for key, _ in first.top()], equal_to(['c', 'a']))
+        assert_that(first.estimate('c'), greater_than_or_equal_to(21))
+
+        assert_that(calling(first.merge).with_args(HeavyHitters(k=2, width=32, depth=2)), raises(ValueError))
+
+    def test_fixed_memory(self):
+        top = HeavyHitters(k=3, width=128, depth=4)
+        for i in xrange(10000):
+            top.add('/uri/%s' % i)
+
+        assert_that(top.candidates, has_length(3))
+        assert_that(top.rows, has_length(4))
+        for row in top.rows:
+            assert_that(row, has_length(128))
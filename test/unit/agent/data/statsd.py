@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import time
+
 from hamcrest import *
 
 from test.base import BaseTestCase
+from amplify.agent.common.context import context
+from amplify.agent.data.eventd import EventdClient
+from amplify.agent.data.sketch import HeavyHitters, TimerSketch
 from amplify.agent.data.statsd import StatsdClient
 
 __author__ = "Mike Belov"
@@ -21,3 +26,173 @@ class StatsdClientTestCase(BaseTestCase):
 
         client.incr('test_negative', value=-200)
         assert_that(len(client.current['counter']), equal_to(1))  # we did't add negative metric
+
+    def test_timer_modes(self):
+        class FakeObject(object):
+            definition = {}
+
+        values = [0.1 * i for i in xrange(1, 200)]
+
+        exact = StatsdClient(object=FakeObject())
+        for value in values:
+            exact.timer('nginx.http.request.time', value)
+        assert_that(exact.current['timer']['nginx.http.request.time'], instance_of(list))
+
+        context.app_config['agent']['timers'] = 'sketch'
+        try:
+            sketch = StatsdClient(object=FakeObject())
+        finally:
+            context.app_config['agent'].pop('timers')
+        for value in values:
+            sketch.timer('nginx.http.request.time', value)
+        assert_that(sketch.current['timer']['nginx.http.request.time'], instance_of(TimerSketch))
+
+        exact_timers = exact.flush()['metrics']['timer']
+        sketch_timers = sketch.flush()['metrics']['timer']
+        assert_that(sorted(sketch_timers), equal_to(sorted(exact_timers)))
+        for key, [[_, value]] in exact_timers.iteritems():
+            assert_that(sketch_timers[key][0][1], close_to(value, value * 0.01 + 1e-9))
+
+    def test_top(self):
+        class FakeObject(object):
+            definition = {}
+
+        client = StatsdClient(object=FakeObject())
+        for keys in (['/a', '/a', '/b'], ['/a', '/c', '/c', '/c']):
+            heavy_hitters = HeavyHitters(k=2)
+            for key in keys:
+                heavy_hitters.add(key)
+            client.top('nginx.http.top.request_uri.2xx', heavy_hitters)
+
+        counter = client.flush()['metrics']['counter']
+        assert_that(counter, has_entries({
+            'C|nginx.http.top.request_uri.2xx|/a': contains(contains(instance_of(int), 3)),
+            'C|nginx.http.top.request_uri.2xx|/c': contains(contains(instance_of(int), 3)),
+        }))
+        assert_that(counter, has_length(2))
+
+    def test_histogram(self):
+        class FakeObject(object):
+            definition = {}
+
+        context.app_config['agent']['timer_buckets'] = '1,0.1,0.5'
+        try:
+            client = StatsdClient(object=FakeObject())
+        finally:
+            context.app_config['agent'].pop('timer_buckets')
+
+        for value in (0.05, 0.1, 0.2, 0.7, 3.0, 4.0):
+            client.timer('nginx.http.request.time', value)
+        client.timer('nginx.upstream.response.time||42', 0.3)
+        client.timer('nginx.something.time', 0.3)
+        assert_that(client.current['histogram']['nginx.http.request.time'], equal_to([2, 1, 1, 2]))
+
+        counter = client.flush()['metrics']['counter']
+        assert_that(counter, has_length(8))
+        for bucket, count in (('0_1', 2), ('0_5', 1), ('1', 1), ('inf', 2)):
+            assert_that(counter['C|nginx.http.request.time.bucket.%s' % bucket][0][1], equal_to(count))
+        assert_that(counter['C|nginx.upstream.response.time.bucket.0_5||42'][0][1], equal_to(1))
+
+    def test_incr(self):
+        class FakeObject(object):
+            definition = {}
+
+        client = StatsdClient(object=FakeObject(), interval=60)
+        client.incr('nginx.http.method.get', stamp=100)
+        client.incr('nginx.http.method.get', value=2, stamp=200)  # stamp of the first value is kept
+        client.incr('nginx.http.method.get', value=3)
+        client.incr('nginx.http.method.post', value=0, stamp=300)
+        client.incr('nginx.http.method.post', value=5, rate=1, stamp=400)  # next slot
+        assert_that(client.current['counter']['nginx.http.method.post'], equal_to([[300, 0], [300, 5]]))
+
+        counter = client.flush()['metrics']['counter']
+        assert_that(counter, equal_to({
+            'C|nginx.http.method.get': [[100, 6]],
+            'C|nginx.http.method.post': [[300, 5]],
+        }))
+
+    def test_flush_without_copies(self):
+        class FakeObject(object):
+            definition = {}
+
+        client = StatsdClient(object=FakeObject())
+        for value in (3.0, 1.0, 2.0):
+            client.timer('nginx.http.request.time', value)
+        samples = client.current['timer']['nginx.http.request.time']
+
+        metrics = client.flush()['metrics']
+        # detached samples were sorted in place, not copied
+        assert_that(samples, equal_to([1.0, 2.0, 3.0]))
+        assert_that(client.current, has_length(0))
+
+        # new values don't get into flushed data
+        client.timer('nginx.http.request.time', 10.0)
+        assert_that(samples, has_length(3))
+        assert_that(metrics['timer']['G|nginx.http.request.time.max'][0][1], equal_to(3.0))
+
+    def test_flush_time_per_sample(self):
+        class FakeObject(object):
+            definition = {}
+
+        def flush_time(count):
+            client = StatsdClient(object=FakeObject())
+            for i in xrange(count):
+                client.timer('nginx.http.request.time||%s' % (i % 10), (i * 7919 % count) / 1000.0)
+                client.incr('nginx.http.method.get||%s' % (i % 10))
+            start = time.time()
+            client.flush()
+            return (time.time() - start) / count
+
+        # best of a few runs to reduce noise, time per sample shouldn't grow much (only sorting is n*log(n))
+        small = min(flush_time(10000) for _ in xrange(3))
+        large = min(flush_time(200000) for _ in xrange(3))
+        assert_that(large, less_than(small * 3))
+
+    def test_max_series(self):
+        class FakeObject(object):
+            definition = {}
+            definition_hash = 'fake'
+
+            def __init__(self):
+                self.eventd = EventdClient(object=self)
+
+        context.app_config['agent']['max_series'] = '3'
+        try:
+            obj = FakeObject()
+            client = StatsdClient(object=obj)
+        finally:
+            context.app_config['agent'].pop('max_series')
+
+        # metrics without dimensions are not limited
+        for i in xrange(5):
+            client.incr('nginx.http.status.%sxx' % i)
+
+        for i in xrange(5):
+            client.incr('nginx.http.method.get||%s' % i)
+            client.timer('nginx.http.request.time||%s' % i, 0.1)
+        client.gauge('system.io.iops_r|sda', 1)  # over the limit too
+        client.incr('nginx.http.method.get||1')  # admitted one still works
+
+        # get||0, time||0 and get||1 were the first ones
+        assert_that(client.current['counter'], has_length(5 + 2 + 1))
+        assert_that(client.current['counter']['nginx.http.method.get||1'][0][1], equal_to(2))
+        assert_that(client.current['timer'], has_length(1))
+        assert_that(client.current['gauge'], has_length(0))
+        assert_that(client.current['counter']['controller.agent.series.dropped'][0][1], equal_to(3 + 4 + 1))
+
+        # one event only
+        events = obj.eventd.flush()['events']
+        assert_that(events, has_length(1))
+        assert_that(events[0]['message'], contains_string('too many metric series'))
+        client.incr('nginx.http.method.get||10')
+        assert_that(obj.eventd.flush(), not_(has_key('events')))
+
+        # series that have not got values during a flush period are forgotten
+        client.flush()
+        client.incr('nginx.http.method.get||0')
+        client.flush()
+        for i in xrange(20, 23):
+            client.incr('nginx.http.method.get||%s' % i)
+        assert_that(client.current['counter'], has_key('nginx.http.method.get||20'))
+        assert_that(client.current['counter'], has_key('nginx.http.method.get||21'))
+        assert_that(client.current['counter'], not_(has_key('nginx.http.method.get||22')))
@@ -3,7 +3,7 @@ import re
 
 from hamcrest import *
 
-from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.objects.nginx.filters import Filter, FilterSet
 from test.base import BaseTestCase
 
 __author__ = "Mike Belov"
@@ -92,3 +92,64 @@ class FiltersTestCase(BaseTestCase):
 
         assert_that(filtr.matchfile('foo.txt'), equal_to(True))
         assert_that(filtr.matchfile('foo.log'), equal_to(True))
+
+
+class FilterSetTestCase(BaseTestCase):
+
+    filters_data = [
+        [['$request_method', '~', 'GET']],
+        [['$request_method', '~', 'post'], ['$status', '~', '2']],
+        [['$request_method', '!~', 'GET'], ['$status', '!~', '200']],
+        [['$status', '~', '5..']],
+        [['$status', '~', '200'], ['$request_uri', '~', '.*\.gif']],
+        [['$request_uri', '~', '/img'], ['$http_user_agent', '~', '.*Safari']],
+        [['$request_uri', '!~', '/img']],
+        [['$request_uri', '~', '/foo[']],  # not a regex, compared as a string
+        [['$request_uri', '!~', '/foo[']],
+        [['$server_protocol', '~', 'HTTP/1.1'], ['$status', '~', '200']],
+        [['$upstream_cache_status', '~', 'HIT']],
+        [['$http_user_agent', '~', '']],
+    ]
+
+    lines = [
+        {'request_method': 'GET', 'status': '200', 'request_uri': '/img/a.gif', 'http_user_agent': 'Safari',
+         'server_protocol': 'HTTP/1.1'},
+        {'request_method': 'POST', 'status': '201', 'request_uri': '/foo[', 'http_user_agent': 'curl',
+         'server_protocol': 'HTTP/1.0'},
+        {'request_method': 'GETX', 'status': '503', 'request_uri': '/imgs', 'http_user_agent': 'Mozilla Safari',
+         'server_protocol': 'HTTP/1.1x', 'upstream_cache_status': 'HIT'},
+        {'request_method': 'HEAD', 'status': '404', 'request_uri': '/foo[/bar', 'http_user_agent': ''},
+        {'request_method': 'GET'},
+        {},
+    ]
+
+    def test_same_as_filters(self):
+        filters = [
+            Filter(filter_rule_id=i, metric='nginx.http.status.2xx', data=data)
+            for i, data in enumerate(self.filters_data)
+        ]
+        filter_set = FilterSet(filters)
+
+        for parsed in self.lines:
+            expected = [f for f in filters if f.match(parsed)]
+            assert_that(filter_set.filters_for(filter_set.match(parsed)), equal_to(expected))
+
+    def test_bitset(self):
+        filters = [
+            Filter(filter_rule_id=1, metric='nginx.http.status.2xx', data=[['$request_method', '~', 'GET']]),
+            Filter(filter_rule_id=2, metric='nginx.http.status.2xx', data=[['$status', '~', '200']]),
+            Filter(filter_rule_id=3, metric='nginx.http.status.2xx', data=[['$status', '!~', '200']]),
+        ]
+        filter_set = FilterSet(filters)
+
+        assert_that(filter_set.match({'request_method': 'GET', 'status': '200'}), equal_to(0b011))
+        assert_that(filter_set.match({'request_method': 'GET', 'status': '404'}), equal_to(0b101))
+        assert_that(filter_set.match({'request_method': 'PUT'}), equal_to(0))
+
+        assert_that(filter_set.filters_for(0b101), equal_to([filters[0], filters[2]]))
+        assert_that(filter_set.filters_for(0), equal_to([]))
+
+    def test_empty(self):
+        filter_set = FilterSet([])
+        assert_that(filter_set.match({'status': '200'}), equal_to(0))
+        assert_that(filter_set.filters_for(0), equal_to([]))
@@ -521,3 +521,59 @@ class LogParserTestCase(BaseTestCase):
         assert_that(parsed['body_bytes_sent'], equal_to(97))
         assert_that(parsed['time_iso8601'], equal_to('2018-07-17T18:07:31+00:00'))
         assert_that(parsed['http_user_agent'], equal_to('nginx-amplify-agent/1.5.0-1'))
+
+    def test_compiled_parse_equals_generic(self):
+        log_format = (
+            '$remote_addr - $remote_user [$time_local] "$request" '
+            '$status $body_bytes_sent "$http_referer" "$http_user_agent" '
+            'rt=$request_time ua="$upstream_addr" us="$upstream_status" '
+            'ut="$upstream_response_time" uct="$upstream_connect_time" ul="$upstream_response_length" '
+            'cs=$upstream_cache_status gz=$gzip_ratio $connection/$connection_requests'
+        )
+        lines = [
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "-" "curl/7.35.0" '
+            'rt=0.010 ua="10.0.0.1:80, 10.0.0.2:80" us="502, 200" ut="2.001, 0.345" uct="0.001, 0.002" ul="512" '
+            'cs=MISS gz=2.5 62277/22',
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "-" "curl/7.35.0" '
+            'rt=1299760000.321 ua="-" us="-" ut="-" uct="" ul="-" cs=- gz=- 1/1',
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "/xxx?q=1 GET" 400 - "-" "-" '
+            'rt=0.000 ua="-" us="-" ut="-" uct="-" ul="-" cs=- gz=- 1/1',
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "\x04\x01\x1F" 400 0 "-" "-" '
+            'rt=0.000 ua="-" us="-" ut="-" uct="-" ul="-" cs=- gz=- 1/1',
+        ]
+
+        parser = NginxAccessLogParser(log_format)
+        assert_that(parser.parse_source, not_none())
+
+        for line in lines:
+            assert_that(parser.parse(line), equal_to(parser.parse_generic(line)))
+
+        # both raise on lines that don't match the format
+        assert_that(calling(parser.parse).with_args('garbage'), raises(ValueError))
+        assert_that(calling(parser.parse_generic).with_args('garbage'), raises(ValueError))
+
+    def test_compiled_parse_duplicate_keys(self):
+        parser = NginxAccessLogParser('$status "$request" $status')
+        line = '200 "GET / HTTP/1.1" 404'
+        assert_that(parser.parse(line), equal_to(parser.parse_generic(line)))
+        assert_that(parser.parse(line), has_entries(status='404', request_method='GET'))
+
+    def test_needed_keys(self):
+        parser = NginxAccessLogParser(needed_keys=['status', 'request'])
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" "curl/7.35.0"'
+
+        parsed = parser.parse(line)
+        assert_that(parsed, has_entries(status='200', request_method='GET', malformed=False))
+        assert_that(parsed, not_(has_key('body_bytes_sent')))
+        assert_that(parsed, not_(has_key('http_user_agent')))
+
+        # values of other keys are not sliced
+        assert_that(parser.parse_source, not_(contains_string('http_referer')))
+
+    def test_needed_keys_truncated(self):
+        parser = NginxAccessLogParser(needed_keys=['status', 'request'])
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-'
+
+        # the line is rejected although all needed values are there
+        assert_that(calling(parser.parse).with_args(line), raises(ValueError))
+        assert_that(calling(parser.parse_generic).with_args(line), raises(ValueError))
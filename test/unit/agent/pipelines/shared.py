@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+
+from hamcrest import *
+
+import amplify.agent.pipelines.shared
+from amplify.agent.pipelines.shared import open_tail
+from test.base import BaseTestCase
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class SharedTailTestCase(BaseTestCase):
+    test_log = 'log/shared.log'
+    test_link = 'log/shared.link'
+
+    def setup_method(self, method):
+        super(SharedTailTestCase, self).setup_method(method)
+        self.write_log('start')
+
+    def teardown_method(self, method):
+        for filename in (self.test_log, self.test_link):
+            if os.path.lexists(filename):
+                os.remove(filename)
+        super(SharedTailTestCase, self).teardown_method(method)
+
+    def write_log(self, *lines):
+        with open(self.test_log, 'a') as f:
+            for line in lines:
+                f.write('%s\n' % line)
+
+    def test_single_reader(self):
+        os.symlink(os.path.basename(self.test_log), self.test_link)
+
+        first = open_tail(self.test_log)
+        second = open_tail(self.test_log)
+        third = open_tail(self.test_link)
+        assert_that(amplify.agent.pipelines.shared.SHARED_FILES, has_length(1))
+        assert_that(second.shared, equal_to(first.shared))
+        assert_that(third.shared, equal_to(first.shared))
+
+        lines = ['this is line %s' % i for i in xrange(5)]
+        self.write_log(*lines)
+
+        # every subscriber gets the same chunk objects
+        first_chunks = list(first.chunks())
+        assert_that(sum(first_chunks, []), equal_to(lines))
+        for tail in (second, third):
+            chunks = list(tail.chunks())
+            assert_that(len(chunks), equal_to(len(first_chunks)))
+            for chunk, first_chunk in zip(chunks, first_chunks):
+                assert_that(chunk, same_instance(first_chunk))
+
+        assert_that(first.readlines(), has_length(0))
+
+    def test_backlog(self):
+        first = open_tail(self.test_log)
+        second = open_tail(self.test_log)
+
+        self.write_log('one', 'two')
+        assert_that(second.backlog(), equal_to(8))
+        first.readlines()
+        assert_that(first.backlog(), equal_to(0))
+        assert_that(second.backlog(), equal_to(8))
+        second.readlines()
+        assert_that(second.backlog(), equal_to(0))
+
+    def test_refcount(self):
+        first = open_tail(self.test_log)
+        second = open_tail(self.test_log)
+        shared = first.shared
+
+        first.stop()
+        assert_that(shared.subscribers, equal_to([second]))
+        assert_that(first.readlines(), has_length(0))
+
+        self.write_log('one')
+        assert_that(second.readlines(), equal_to(['one']))
+
+        # the last subscriber closes the file
+        second.stop()
+        assert_that(amplify.agent.pipelines.shared.SHARED_FILES, has_length(0))
+
+        # restarted object continues from the same offset
+        self.write_log('two')
+        third = open_tail(self.test_log)
+        assert_that(third.shared, is_not(same_instance(shared)))
+        assert_that(third.readlines(), equal_to(['two']))
+
+    def test_max_pending(self):
+        fast = open_tail(self.test_log)
+        slow = open_tail(self.test_log)
+        slow.max_pending = 3
+        fast.readlines()
+        slow.readlines()
+
+        # every write is read in a chunk of its own by the fast subscriber
+        for i in xrange(5):
+            self.write_log('one %s' % i, 'two %s' % i)
+            assert_that(fast.readlines(), has_length(2))
+
+        # the slow one keeps only the newest chunks
+        assert_that(slow.pending_lines, equal_to(2))
+        assert_that(slow.readlines(), equal_to(['one 4', 'two 4']))
+        assert_that(slow.dropped(), equal_to({'overflow': 8}))
+        assert_that(slow.dropped(), equal_to({}))
+        assert_that(fast.dropped(), equal_to({}))
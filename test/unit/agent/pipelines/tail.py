@@ -4,7 +4,11 @@ from shutil import copyfile
 
 from hamcrest import *
 
-from amplify.agent.pipelines.file import FileTail
+import amplify.agent.pipelines.file
+import amplify.agent.pipelines.inotify
+from amplify.agent.common.context import context
+from amplify.agent.pipelines.file import FileTail, get_offset_store, save_offsets
+from amplify.agent.pipelines.inotify import get_watcher
 from test.base import BaseTestCase
 
 __author__ = "Mike Belov"
@@ -17,6 +21,7 @@ __email__ = "dedm@nginx.com"
 class TailTestCase(BaseTestCase):
     test_log = 'log/something.log'
     test_log_rotated = 'log/something.log.rotated'
+    test_offsets = 'log/offsets.json'
 
     def setup_method(self, method):
         # write something to create file
@@ -33,7 +38,7 @@ class TailTestCase(BaseTestCase):
 
     def teardown_method(self, method):
         # remove test log
-        for filename in (self.test_log, self.test_log_rotated):
+        for filename in (self.test_log, self.test_log_rotated, self.test_offsets):
             if os.path.exists(filename):
                 os.remove(filename)
 
@@ -143,3 +148,258 @@ class TailTestCase(BaseTestCase):
         lines = tail.readlines()
         assert_that(lines, has_length(1))
         assert_that(lines[0], ends_with('    '))
+
+    def test_partial_line_carried_over(self):
+        tail = FileTail(filename=self.test_log)
+        start_offset = tail._offset
+
+        with open(self.test_log, 'a') as f:
+            f.write('first line\nsecond li')
+
+        assert_that(tail.readlines(), equal_to(['first line']))
+        # partial line is not counted as read
+        assert_that(tail._offset, equal_to(start_offset + len('first line\n')))
+
+        with open(self.test_log, 'a') as f:
+            f.write('ne\r\nthird line\n')
+
+        assert_that(tail.readlines(), equal_to(['second line', 'third line']))
+        assert_that(tail._offset, equal_to(os.path.getsize(self.test_log)))
+
+    def test_chunks(self):
+        tail = FileTail(filename=self.test_log)
+        tail.chunk_size = 16
+
+        lines = ['this is line %s' % i for i in xrange(10)]
+        for line in lines:
+            self.write_log(line)
+
+        chunks = list(tail.chunks())
+        assert_that(len(chunks), greater_than(1))
+        for chunk in chunks:
+            assert_that(chunk, instance_of(list))
+
+        assert_that(sum(chunks, []), equal_to(lines))
+        assert_that(tail.readlines(), has_length(0))
+
+    def test_next(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('first')
+        self.write_log('second')
+
+        assert_that(next(tail), equal_to('first'))
+        assert_that(tail.next(), equal_to('second'))
+        assert_that(calling(next).with_args(tail), raises(StopIteration))
+
+        # lines written after the end was reached
+        self.write_log('third')
+        assert_that(next(tail), equal_to('third'))
+
+    def test_backlog(self):
+        tail = FileTail(filename=self.test_log)
+        tail.chunk_size = 16
+        assert_that(tail.backlog(), equal_to(0))
+
+        lines = ['this is line %s' % i for i in xrange(10)]
+        for line in lines:
+            self.write_log(line)
+        assert_that(tail.backlog(), equal_to(sum(len(line) + 1 for line in lines)))
+
+        # stop in the middle, the rest is still there
+        chunks = tail.chunks()
+        first = next(chunks)
+        assert_that(tail.backlog(), equal_to(sum(len(line) + 1 for line in lines[len(first):])))
+
+        assert_that(first + sum(chunks, []), equal_to(lines))
+        assert_that(tail.backlog(), equal_to(0))
+
+
+class PollingTailTestCase(TailTestCase):
+    """
+    Same tests without inotify
+    """
+
+    def setup_method(self, method):
+        self.original_watcher = amplify.agent.pipelines.inotify.WATCHER
+        amplify.agent.pipelines.inotify.WATCHER = False
+        super(PollingTailTestCase, self).setup_method(method)
+
+    def teardown_method(self, method):
+        amplify.agent.pipelines.inotify.WATCHER = self.original_watcher
+        super(PollingTailTestCase, self).teardown_method(method)
+
+    def test_no_watch(self):
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.watch, equal_to(None))
+
+
+class InotifyTestCase(TailTestCase):
+
+    def test_watch(self):
+        watcher = get_watcher()
+        assert_that(watcher, not_none())
+
+        watch = watcher.add(self.test_log)
+        assert_that(watch.pending(), equal_to(True))
+        watcher.read_events()
+        watch.modified = watch.rotated = False
+
+        # nothing happened
+        watcher.read_events()
+        assert_that(watch.pending(), equal_to(False))
+
+        # write
+        self.write_log('something')
+        watcher.read_events()
+        assert_that(watch.modified, equal_to(True))
+        assert_that(watch.rotated, equal_to(False))
+        watch.modified = False
+
+        # rotate
+        os.rename(self.test_log, self.test_log_rotated)
+        watcher.read_events()
+        assert_that(watch.rotated, equal_to(True))
+        watch.modified = watch.rotated = False
+
+        # new file appears in place of the old one
+        self.write_log('something')
+        watcher.read_events()
+        assert_that(watch.rotated, equal_to(True))
+
+        watcher.remove(watch)
+        assert_that(watcher.file_watches, is_not(has_key(watch.wd)))
+        assert_that(watcher.dir_watches, is_not(has_key(watch.dir_wd)))
+
+    def test_idle_tail_does_not_touch_file(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('something')
+        assert_that(tail.readlines(), equal_to(['something']))
+
+        def fail(*args, **kwargs):
+            raise AssertionError('file should not be checked')
+
+        original_filehandle = tail._filehandle
+        tail._filehandle = fail
+        assert_that(tail.readlines(), equal_to([]))
+
+        tail._filehandle = original_filehandle
+        self.write_log('something else')
+        assert_that(tail.readlines(), equal_to(['something else']))
+
+    def test_follow_rotated_file(self):
+        tail = FileTail(filename=self.test_log)
+
+        for i in xrange(3):
+            os.rename(self.test_log, self.test_log_rotated)
+            self.write_log('from new file %s' % i)
+            assert_that(tail.readlines(), equal_to(['from new file %s' % i]))
+
+        # the watch has moved to the new file
+        self.write_log('one more line')
+        assert_that(tail.readlines(), equal_to(['one more line']))
+
+    def test_stop(self):
+        tail = FileTail(filename=self.test_log)
+        watch = tail.watch
+        assert_that(tail.watcher.file_watches[watch.wd], has_item(watch))
+
+        tail.stop()
+        assert_that(tail.watch, equal_to(None))
+        assert_that(watch.wd, equal_to(None))
+
+
+class OffsetStoreTestCase(TailTestCase):
+
+    def setup_method(self, method):
+        super(OffsetStoreTestCase, self).setup_method(method)
+        context.app_config['nginx']['log_offsets'] = self.test_offsets
+
+    def teardown_method(self, method):
+        context.app_config['nginx'].pop('log_offsets', None)
+        context.app_config['nginx'].pop('log_max_catchup', None)
+        super(OffsetStoreTestCase, self).teardown_method(method)
+
+    def restart_agent(self):
+        amplify.agent.pipelines.file.OFFSET_CACHE = {}
+        amplify.agent.pipelines.file.OFFSET_STORE = None
+
+    def test_resume_after_restart(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('before restart')
+        assert_that(tail.readlines(), equal_to(['before restart']))
+        tail.stop()
+
+        self.restart_agent()
+        self.write_log('during restart')
+
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['during restart']))
+
+    def test_batched_save(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('something')
+        tail.readlines()
+
+        store = get_offset_store()
+        assert_that(store.dirty, equal_to(True))
+
+        save_offsets()
+        assert_that(store.dirty, equal_to(False))
+        assert_that(os.path.exists(self.test_offsets), equal_to(True))
+
+        # no writes if nothing changed
+        os.remove(self.test_offsets)
+        save_offsets()
+        assert_that(os.path.exists(self.test_offsets), equal_to(False))
+
+    def test_file_replaced_during_restart(self):
+        tail = FileTail(filename=self.test_log)
+        tail.stop()
+
+        self.restart_agent()
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['from a new file']))
+
+    def test_max_catchup(self):
+        context.app_config['nginx']['log_max_catchup'] = '30'
+
+        tail = FileTail(filename=self.test_log)
+        tail.stop()
+
+        self.restart_agent()
+        for i in xrange(10):
+            self.write_log('this is line %s' % i)
+
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), equal_to(['this is line 8', 'this is line 9']))
+
+    def test_prune(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('something')
+        tail.readlines()
+
+        store = get_offset_store()
+        store.update(u'log/deleted.log', 1, 2, 100)  # a file that doesn't exist anymore
+        store.update(self.test_log_rotated, 1, 2, 100)
+        self.write_log('rotated')
+        os.rename(self.test_log, self.test_log_rotated)  # replaced by another file
+        store.save(force=True)
+
+        assert_that(store.offsets, has_length(0))
+
+    def test_path_types(self):
+        tail = FileTail(filename=self.test_log)
+        tail.stop()
+
+        self.restart_agent()
+        store = get_offset_store()
+        assert_that(store.offsets.keys(), equal_to([self.test_log]))
+        assert_that(store.offsets.keys()[0], instance_of(str))
+
+        # unicode and str paths are the same entry
+        store.update(unicode(self.test_log), 0, 0, 10)
+        assert_that(store.offsets, has_length(1))
+        assert_that(store.get(self.test_log, 0, 0), equal_to(10))
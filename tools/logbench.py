@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import gc
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# make amplify libs available
+script_location = os.path.abspath(os.path.expanduser(__file__))
+agent_repo_path = os.path.dirname(os.path.dirname(script_location))
+agent_config_file = os.path.join(agent_repo_path, 'etc', 'agent.conf.development')
+sys.path.append(agent_repo_path)
+
+# setup agent config
+from amplify.agent.common.context import context
+context.setup(app='agent', config_file=agent_config_file)
+
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.objects.abstract import AbstractObject
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
+from amplify.agent.pipelines.file import FileTail
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+FORMATS = {
+    'combined': NginxAccessLogParser.combined_format,
+    'upstreams': (
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" "$http_x_forwarded_for" rt=$request_time ua="$upstream_addr" us="$upstream_status" '
+        'ut="$upstream_response_time" uct="$upstream_connect_time" uht="$upstream_header_time" '
+        'ul="$upstream_response_length" cs=$upstream_cache_status gz=$gzip_ratio'
+    ),
+    'heavy': (
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" "$http_x_forwarded_for" host=$host sn=$server_name rl=$request_length '
+        'bs=$bytes_sent rt=$request_time ua="$upstream_addr" us="$upstream_status" ut="$upstream_response_time" '
+        'uct="$upstream_connect_time" uht="$upstream_header_time" ul="$upstream_response_length" '
+        'cs=$upstream_cache_status gz=$gzip_ratio ssl=$ssl_protocol/$ssl_cipher id=$request_id '
+        'conn=$connection reqs=$connection_requests pipe=$pipe'
+    ),
+}
+
+METHODS = ['GET'] * 80 + ['POST'] * 12 + ['HEAD'] * 3 + ['PUT', 'DELETE', 'OPTIONS', 'PATCH', 'PROPFIND']
+STATUSES = ['200'] * 70 + ['304'] * 8 + ['301', '302'] * 3 + ['404'] * 5 + ['403', '400', '499', '500', '503', '504']
+PROTOCOLS = ['HTTP/1.1'] * 70 + ['HTTP/2.0'] * 25 + ['HTTP/1.0'] * 5
+CACHE_STATUSES = ['-'] * 40 + ['HIT'] * 30 + ['MISS'] * 20 + ['EXPIRED', 'BYPASS', 'STALE', 'UPDATING', 'REVALIDATED']
+AGENTS = [
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/43.0.2357.124 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:57.0) Gecko/20100101 Firefox/57.0',
+    'python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic',
+    'curl/7.35.0',
+    'Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)',
+]
+PATHS = ['/', '/api/v1/objects/', '/img/docker.png', '/static/app.js', '/login', '/search?q=nginx&page=2']
+
+# share of malformed lines ($request isn't an HTTP request)
+MALFORMED_RATIO = 0.01
+
+
+class LogGenerator(object):
+    """
+    Generates access log lines for a log_format with realistic values of known variables
+    """
+
+    def __init__(self, log_format, seed=0):
+        self.random = random.Random(seed)
+        self.parts = re.split(r'\$([a-z0-9_]+)', log_format)
+
+    def upstreams(self):
+        return self.random.choice((1, 1, 1, 1, 2, 3))
+
+    def value(self, name, upstreams):
+        rnd = self.random
+        if name == 'remote_addr':
+            return '%d.%d.%d.%d' % tuple(rnd.randint(1, 254) for _ in range(4))
+        elif name == 'time_local':
+            return '18/Jun/2015:17:22:%02d +0000' % rnd.randint(0, 59)
+        elif name == 'request':
+            if rnd.random() < MALFORMED_RATIO:
+                return '\\x16\\x03\\x01\\x00\\xa5\\x01'
+            return '%s %s %s' % (rnd.choice(METHODS), rnd.choice(PATHS), rnd.choice(PROTOCOLS))
+        elif name == 'status':
+            return rnd.choice(STATUSES)
+        elif name in ('body_bytes_sent', 'bytes_sent', 'request_length'):
+            return str(rnd.randint(0, 100000))
+        elif name == 'http_user_agent':
+            return rnd.choice(AGENTS)
+        elif name == 'http_referer':
+            return rnd.choice(('-', 'http://example.com/', 'https://www.google.com/'))
+        elif name == 'request_time':
+            return '%.3f' % rnd.expovariate(20)
+        elif name == 'upstream_addr':
+            return ', '.join('10.0.0.%d:80' % rnd.randint(1, 20) for _ in range(upstreams))
+        elif name == 'upstream_status':
+            return ', '.join(rnd.choice(STATUSES[:80] + ['502']) for _ in range(upstreams))
+        elif name.startswith('upstream') and name.endswith('_time'):
+            return ', '.join('%.3f' % rnd.expovariate(25) for _ in range(upstreams))
+        elif name == 'upstream_response_length':
+            return ', '.join(str(rnd.randint(0, 100000)) for _ in range(upstreams))
+        elif name == 'upstream_cache_status':
+            return rnd.choice(CACHE_STATUSES)
+        elif name == 'gzip_ratio':
+            return rnd.choice(('-', '%.2f' % rnd.uniform(1, 8)))
+        elif name in ('host', 'server_name'):
+            return rnd.choice(('example.com', 'api.example.com', 'static.example.com'))
+        elif name in ('connection', 'connection_requests'):
+            return str(rnd.randint(1, 1000))
+        elif name == 'request_id':
+            return '%032x' % rnd.getrandbits(128)
+        elif name == 'ssl_protocol':
+            return rnd.choice(('TLSv1.2', 'TLSv1.3'))
+        elif name == 'ssl_cipher':
+            return 'ECDHE-RSA-AES128-GCM-SHA256'
+        elif name == 'pipe':
+            return rnd.choice(('.', 'p'))
+        return '-'
+
+    def line(self):
+        upstreams = self.upstreams()
+        parts = self.parts[:]
+        for i in xrange(1, len(parts), 2):
+            parts[i] = self.value(parts[i], upstreams)
+        return ''.join(parts)
+
+    def lines(self, count):
+        return [self.line() for _ in xrange(count)]
+
+
+def make_filters(count):
+    """
+    Cloud-like custom filters
+    """
+    templates = [
+        ('nginx.http.status.2xx', [['$request_method', '~', 'GET']]),
+        ('nginx.http.request.time.pctl95', [['$request_uri', '~', '/api/.*']]),
+        ('nginx.http.request.bytes_sent', [['$status', '~', '5..']]),
+        ('nginx.upstream.response.time.median', [['$http_user_agent', '!~', '.*bot.*']]),
+        ('nginx.http.method.post', [['$request_uri', '~', '/login'], ['$status', '~', '200']]),
+    ]
+    filters = []
+    for i in xrange(count):
+        metric, data = templates[i % len(templates)]
+        filters.append(Filter(filter_rule_id=i, metric=metric, data=data))
+    return filters
+
+
+class BenchObject(AbstractObject):
+    type = 'nginx'
+
+
+def object_stub(filters):
+    obj = BenchObject(data={'bin_path': '/usr/sbin/nginx', 'conf_path': '/etc/nginx/nginx.conf', 'local_id': 1})
+    obj.filters = filters
+    return obj
+
+
+def collect_all(collector):
+    """
+    Collects until the whole tail is processed: the budget of a collect cycle (log_budget_time/log_budget_lines)
+    would otherwise stop the benchmark after the first second of work
+
+    :return: int number of lines processed
+    """
+    collector.budget_time = 0
+    collector.budget_lines = 0
+
+    processed = [0]
+    collect_chunks = collector.collect_chunks
+
+    def counting_collect_chunks(chunks):
+        count, exhausted = collect_chunks(chunks)
+        processed[0] += count
+        return count, exhausted
+
+    collector.collect_chunks = counting_collect_chunks
+    collector.collect()
+    while collector.backlog is not None:
+        collector.collect()
+    return processed[0]
+
+
+def bench_parse(log_format, lines, args):
+    parser = NginxAccessLogParser(log_format)
+    parse = parser.parse
+    start = time.time()
+    for line in lines:
+        parse(line)
+    return len(lines), time.time() - start
+
+
+def bench_collect_list(log_format, lines, args):
+    obj = object_stub(make_filters(args.filters))
+    collector = NginxAccessLogsCollector(object=obj, log_format=log_format, tail=lines)
+    start = time.time()
+    count = collect_all(collector)
+    return count, time.time() - start
+
+
+def bench_collect_file(log_format, lines, args):
+    tmp_dir = tempfile.mkdtemp(prefix='logbench')
+    try:
+        filename = os.path.join(tmp_dir, 'access.log')
+        open(filename, 'w').close()
+        tail = FileTail(filename)
+        with open(filename, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        obj = object_stub(make_filters(args.filters))
+        collector = NginxAccessLogsCollector(object=obj, log_format=log_format, tail=tail)
+        start = time.time()
+        count = collect_all(collector)
+        return count, time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_flush(log_format, lines, args):
+    obj = object_stub(make_filters(args.filters))
+    count = collect_all(NginxAccessLogsCollector(object=obj, log_format=log_format, tail=lines))
+    start = time.time()
+    obj.statsd.flush()
+    return count, time.time() - start
+
+
+BENCHMARKS = (
+    ('parse', bench_parse),
+    ('collect-list', bench_collect_list),
+    ('collect-file', bench_collect_file),
+    ('flush', bench_flush),
+)
+
+
+def run(func, log_format, lines, args):
+    """
+    Runs a benchmark in a forked process, so peak RSS of every benchmark is measured separately
+
+    :return: {} of results
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            # python 2 has no allocation counters (no tracemalloc, no COUNT_ALLOCS in release builds),
+            # so objects retained by the run are measured: gc-tracked objects alive after a full collection
+            gc.collect()
+            objects_before = len(gc.get_objects())
+            count, elapsed = func(log_format, lines, args)
+            gc.collect()
+            objects_after = len(gc.get_objects())
+
+            result = {
+                'lines_per_sec': count / elapsed if elapsed else 0.0,
+                'seconds': elapsed,
+                'retained_per_line': float(objects_after - objects_before) / count if count else 0.0,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            }
+            os.write(write_fd, json.dumps(result))
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else None
+
+
+def parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='A benchmark of NGINX Amplify access log processing')
+    parser.add_argument('-n', '--lines', type=int, default=100000, help='number of generated lines per run')
+    parser.add_argument('-f', '--format', choices=sorted(FORMATS), help='run only one log format')
+    parser.add_argument('-b', '--benchmark', choices=[name for name, _ in BENCHMARKS], help='run only one benchmark')
+    parser.add_argument('--filters', type=int, default=10, help='number of custom filters for collectors')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for generated lines')
+    parser.add_argument('--save', metavar='file', help='save results as json')
+    parser.add_argument('--compare', metavar='file', help='compare with results saved before')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # lines/sec of flush is lines collected before flush per second of flush,
+    # retained/line is gc-tracked objects per line still alive after the run (not all allocations)
+    print '%-24s %12s %14s %14s' % ('benchmark', 'lines/sec', 'retained/line', 'peak RSS, MB')
+
+    results = {}
+    for format_name in sorted(FORMATS):
+        if args.format and format_name != args.format:
+            continue
+
+        log_format = FORMATS[format_name]
+        lines = LogGenerator(log_format, seed=args.seed).lines(args.lines)
+
+        for bench_name, func in BENCHMARKS:
+            if args.benchmark and bench_name != args.benchmark:
+                continue
+
+            name = '%s:%s' % (bench_name, format_name)
+            result = results[name] = run(func, log_format, lines, args)
+            if result is None:
+                print '%-24s failed' % name
+                continue
+
+            line = '%-24s %12.0f %14.2f %14.1f' % (
+                name, result['lines_per_sec'], result['retained_per_line'], result['peak_rss_mb']
+            )
+            if name in baseline:
+                before = baseline[name]['lines_per_sec']
+                line += '   %+.1f%% lines/sec' % ((result['lines_per_sec'] / before - 1) * 100 if before else 0)
+            print line
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
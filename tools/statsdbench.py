@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+# make amplify libs available
+script_location = os.path.abspath(os.path.expanduser(__file__))
+agent_repo_path = os.path.dirname(os.path.dirname(script_location))
+agent_config_file = os.path.join(agent_repo_path, 'etc', 'agent.conf.development')
+sys.path.append(agent_repo_path)
+
+# setup agent config
+from amplify.agent.common.context import context
+context.setup(app='agent', config_file=agent_config_file)
+
+from amplify.agent.data.statsd import StatsdClient
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class BenchObject(object):
+    definition = {'type': 'nginx'}
+
+
+# metric names used by benchmarks, like the ones of an access log collector with a few filters
+NAMES = ['nginx.http.status.%sxx' % i for i in xrange(1, 6)] + \
+        ['nginx.http.method.get||%s' % i for i in xrange(10)]
+
+
+def client(timers='exact'):
+    context.app_config['agent']['timers'] = timers
+    try:
+        return StatsdClient(object=BenchObject(), interval=60)
+    finally:
+        context.app_config['agent'].pop('timers')
+
+
+def bench_incr(count):
+    incr = client().incr
+    names = NAMES * (count // len(NAMES))
+    start = time.time()
+    for name in names:
+        incr(name, 1)
+    return len(names), time.time() - start
+
+
+def bench_incr_rate(count):
+    incr = client().incr
+    names = NAMES * (count // len(NAMES))
+    start = time.time()
+    for name in names:
+        incr(name, 1, rate=1)
+    return len(names), time.time() - start
+
+
+def bench_incr_new(count):
+    statsd = client()
+    names = ['nginx.http.method.get||%s' % i for i in xrange(count)]
+    start = time.time()
+    for name in names:
+        statsd.incr(name, 1)
+    return len(names), time.time() - start
+
+
+def bench_gauge(count):
+    gauge = client().gauge
+    names = NAMES * (count // len(NAMES))
+    start = time.time()
+    for name in names:
+        gauge(name, 1.0)
+    return len(names), time.time() - start
+
+
+def bench_timer(count, timers='exact'):
+    timer = client(timers).timer
+    names = NAMES * (count // len(NAMES))
+    start = time.time()
+    for i, name in enumerate(names):
+        timer(name, i * 0.001)
+    return len(names), time.time() - start
+
+
+def bench_timer_sketch(count):
+    return bench_timer(count, timers='sketch')
+
+
+def bench_flush(count):
+    statsd = client()
+    for i, name in enumerate(NAMES * (count // len(NAMES))):
+        statsd.incr(name)
+        statsd.gauge(name, 1.0)
+        statsd.timer(name, i * 0.001)
+    start = time.time()
+    statsd.flush()
+    return count, time.time() - start
+
+
+BENCHMARKS = (
+    ('incr', bench_incr),
+    ('incr-rate', bench_incr_rate),
+    ('incr-new', bench_incr_new),
+    ('gauge', bench_gauge),
+    ('timer', bench_timer),
+    ('timer-sketch', bench_timer_sketch),
+    ('flush', bench_flush),
+)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='A microbenchmark of StatsdClient')
+    parser.add_argument('-n', '--count', type=int, default=300000, help='number of calls per benchmark')
+    parser.add_argument('-b', '--benchmark', choices=[name for name, _ in BENCHMARKS], help='run only one benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of every benchmark (the best one is shown)')
+    args = parser.parse_args()
+
+    # ops/sec of flush is values stored before flush per second of flush
+    print '%-16s %14s' % ('benchmark', 'ops/sec')
+    for name, func in BENCHMARKS:
+        if args.benchmark and name != args.benchmark:
+            continue
+
+        best = None
+        for _ in xrange(args.repeat):
+            count, elapsed = func(args.count)
+            rate = count / elapsed if elapsed else 0.0
+            best = rate if best is None else max(best, rate)
+        print '%-16s %14.0f' % (name, best)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import asyncore
+import time
 import socket
 
+import gevent
+
 from optparse import OptionParser, Option
 from collections import deque
 
@@ -16,7 +18,7 @@ context.setup(
     config_file='etc/agent.conf.development',
 )
 
-from amplify.agent.pipelines.syslog import SyslogServer
+from amplify.agent.pipelines.syslog import SyslogListener
 
 
 __author__ = "Grant Hulegaard"
@@ -29,25 +31,29 @@ __email__ = "grant.hulegaard@nginx.com"
 # HELPERS
 
 
-cache = deque(maxlen=10000)
+cache = deque(maxlen=10000000)
 
 
-class UDPClient(asyncore.dispatcher):
-    """Sends datagrams to a socket"""
+class UDPClient(object):
+    """Sends datagrams to a socket at a given rate"""
 
-    def __init__(self, address):
+    def __init__(self, address, rate):
         self.counter = 0
-        self.template = "This is message #%s"
-        asyncore.dispatcher.__init__(self)
-
-        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)  # asyncore socket wrapper
-        self.connect(address)
-
-    def handle_write(self):
-        self.counter += 1
-        message = self.template % self.counter
-        self.send(message)
-        context.log.debug('Sent %s' % message)
+        self.rate = rate
+        self.template = "<190>Jan  1 00:00:00 localhost nginx: This is message #%s"
+        self.address = address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, duration):
+        # lines are sent in 10ms slices, the listener runs in between
+        per_slice = max(1, int(self.rate * 0.01))
+        start = time.time()
+        while time.time() - start < duration:
+            slice_start = time.time()
+            for _ in xrange(per_slice):
+                self.counter += 1
+                self.socket.sendto(self.template % self.counter, self.address)
+            gevent.sleep(max(0.0, 0.01 - (time.time() - slice_start)))
 
 
 # SCRIPT
@@ -71,6 +77,22 @@ option_list = (
         help='socket port',
         default='514'
     ),
+    Option(
+        '-r', '--rate',
+        action='store',
+        dest='rate',
+        type='int',
+        help='lines per second',
+        default='50000'
+    ),
+    Option(
+        '-d', '--duration',
+        action='store',
+        dest='duration',
+        type='float',
+        help='seconds to send lines for',
+        default='5'
+    ),
 )
 
 parser = OptionParser(usage, option_list=option_list)
@@ -79,9 +101,16 @@ parser = OptionParser(usage, option_list=option_list)
 
 if __name__ == '__main__':
     address = (options.address, options.port)
-    server = SyslogServer(cache, address)
-    client = UDPClient(address)
-
-    while True:
-        context.log.debug('Main event loop; cache length: %s' % len(cache))
-        asyncore.loop(timeout=1, count=100)
+    listener = SyslogListener(cache, address, interval=0.1)
+    client = UDPClient(listener.server.address, options.rate)
+
+    thread = gevent.spawn(listener.start)
+    gevent.spawn(client.send, options.duration).join()
+    gevent.sleep(0.5)  # let the listener drain what's left
+    thread.kill()
+    listener.stop()
+
+    lost = client.counter - len(cache)
+    print 'sent: %s, received: %s, lost: %s (%.2f%%)' % (
+        client.counter, len(cache), lost, 100.0 * lost / max(client.counter, 1)
+    )